@@ -1,11 +1,35 @@
-from itertools import product
 import numpy as np
-import glob,re,json
+import glob,re,json,heapq,time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
+from .CPT import *
 from .Node import *
+from .Messages import *
+from .JunctionTree import *
+from .Cache import *
+from .Sampling import *
+from .Monitor import *
+from .Structure import *
+from .Fitting import *
 
 __all__ = ['BayesNet']
 
+_MAGIC = b'BAYESNET' ### first bytes of a file written by BayesNet.SaveBinary
+
+_shared = {} ### state inherited by forked worker processes, see BayesNet.__Executor
+
+def _UpdateMsgsWorker(task):
+    """
+    Compute the new messages of a range of edges in a worker process. The current and new messages live in shared memory,
+    the task says which of the two buffers of each direction receives the new messages.
+    """
+    lo, hi, new = task
+    graph, down, up = _shared['graph'], _shared['down'], _shared['up']
+    graph.m_down.buf, graph.m_up.buf = down[1-new], up[1-new]
+    graph.UpdateMsgs(lo, hi, down[new], up[new])
+
+
 class BayesNet():
     """
     Bayes Net object. A Bayesian network consists of a set of Nodes and a set of directed edges. On each edge is 
@@ -18,17 +42,38 @@ class BayesNet():
         3) set of upstream messages living on the edges
         4) set of Nodes 
     
-    Messages are updated using belief propagation algorithm.
+    Messages are updated using belief propagation algorithm. With log_domain set, messages are stored and merged as log 
+    probabilities, which does not underflow on nodes with many children or parents. dtype sets the precision of the stored 
+    messages, e.g. np.float32 halves the message memory.
     """
-    def __init__(self, data = None, interactions = None, **attr):
+    def __init__(self, data = None, interactions = None, alpha = 0., log_domain = False, dtype = np.float64, sparse = False, **attr):
         self.edges = []  ### edges between node instances
         self.m_down = {} ### upstream messages container
         self.m_up = {}   ### downstream messages container
+        self.log_domain = log_domain ### whether messages are log probabilities
+        self.dtype = dtype ### floating point type of the message buffers
         self.Nodes = {}  ### dictionary containing node names as keys and node instances as values
+        self.compiled = False ### whether the integer indexed representation of the graph is up to date
+        self.junction_tree = None ### junction tree compiled for exact inference
+        self.sampler = None ### topological order and CPTs compiled for sampling
+        self.__batch_evidence = None ### evidence of each node for a batch of scenarios, see query_batch
+        self.calibrated = False ### whether the messages are converged for the evidence of the nodes in changed
+        self.changed = set() ### nodes whose evidence changed since the last calibration
+        self.version = 0 ### incremented whenever the structure or CPTs change
+        self.__cpt_versions = None ### versions of the CPTs when the network was last calibrated, see __CPTVersions
+        self.__jt_versions = None ### versions of the CPTs the junction tree was compiled from
+        self.__sampler_versions = None ### versions of the CPTs the sampler was compiled from
+        self.cache = None ### cache of calibrated beliefs, see EnableCache
+        self.__result = None ### BPResult of the running BeliefPropagation call
+        self.__observer = None ### Observer of the running BeliefPropagation call
+        self.__verbose = True ### whether BeliefPropagation prints its progress
+        self.__max_product = False ### whether CPT contractions maximize rather than sum over the other nodes, see MAP
     
-        if data is not None and interactions is not None:
+        if isinstance(data, basestring) and interactions is not None:
+            self.StreamFromCSV(data, interactions, alpha=alpha, sparse=sparse, **attr)
+        elif data is not None and interactions is not None:
             self.NodesFromCSV(data)
-            self.InteractionsFromCSV(interactions,data)
+            self.InteractionsFromCSV(interactions,data,alpha,sparse)
         return
     
     def NodesFromCSV( self, dat):
@@ -41,35 +86,197 @@ class BayesNet():
         print 'Loading node data from csv file....'
         for label in dat.keys():
             self.Nodes[label] = Node()
-            self.Nodes[label].levels = max(dat[label])+1
+            self.Nodes[label].levels = int(dat[label].max()+1)
+        self.__Modified()
         return
         
-    def InteractionsFromCSV( self, interactions, dat):
+    def InteractionsFromCSV( self, interactions, dat, alpha = 0., sparse = False, workers = None):
         """
-        Import the interactions from a *csv file. 
+        Import the interactions from a *csv file. dat is encoded once into an integer matrix and each CPT is estimated from 
+        a single count of its rows over the (parents, node) levels. Count tables are shared between families through a 
+        CountCache, e.g. the prior of a node is summed out of the table of a family it belongs to, and the other tables can 
+        be counted on a pool of worker processes.
+
+        With sparse, the CPTs of nodes with parents only hold the parent configurations found in dat (see SparseCPT), so 
+        their memory and the cost of the message updates scale with the observed configurations rather than with the 
+        product of the parent levels.
 
         INPUT:  interactions - a dictionary. key=dependent node, value=list of nodes which the key is dependent on. Names are from the column names of dat
                 dat - a panadas data frame of the relevant data
+                alpha - Dirichlet/Laplace smoothing pseudo-count. Default 0 leaves all-zeros rows for unseen parent combinations
+                sparse - whether to store sparse CPTs
+                workers - number of processes counting the families, None to count in the calling process
         OUTPUT: a BayesNet with the interactions 
         """
         print 'Loading interaction information....'
+        used = set(interactions) | set( k for nodes in interactions.values() for k in nodes )
+        labels = [ k for k in dat.keys() if k in used ]
+        column = dict( (k, i) for i, k in enumerate(labels) )
+        data = CountCache([dat[k].values for k in labels], [self.Nodes[k].levels for k in labels])
+        families = dict( (node_k, [column[k] for k in nodes] + [column[node_k]]) for node_k, nodes in interactions.items() )
+        
+        cpts = {}
+        if sparse:
+            for node_k, nodes in interactions.items():
+                if len(nodes) > 0:
+                    shape = [data.levels[c] for c in families[node_k]]
+                    cpts[node_k] = SparseCPT.FromData(data.codes[:, families[node_k]], shape, alpha)
+        
+        dense = [ node_k for node_k in interactions if node_k not in cpts ]
+        data.Prefetch([families[node_k] for node_k in dense], workers)
+        counts = dict( (node_k, data.Counts(families[node_k])) for node_k in dense )
+        if not sparse:
+            self.InteractionsFromCounts(interactions, counts, alpha)
+            return
+        for node_k in dense:
+            cpts[node_k] = CPT.FromCounts(counts[node_k], alpha)
+        self.__SetInteractions(interactions, cpts)
+    
+    
+    def StreamFromCSV( self, csv_file, interactions, chunksize = 100000, alpha = 0., sparse = False, **kwargs):
+        """
+        Import the nodes and interactions from a *.csv file that does not fit in memory. The file is read in chunks and only 
+        the running counts of each (parents, node) configuration are kept, so memory is bounded by the CPT sizes. Levels are 
+        grown as larger values are met, giving the same nodes and CPTs as NodesFromCSV followed by InteractionsFromCSV.
+
+        With sparse, the nodes with parents get a SparseCPT. Their records are kept deduplicated with a count each instead 
+        of a dense table of counts, so memory scales with the distinct records found in the file.
+
+        INPUT:  csv_file - path to the *.csv file
+                interactions - a dictionary. key=dependent node, value=list of nodes which the key is dependent on. Names are from the column names of the file
+                chunksize - number of rows read at a time
+                alpha - Dirichlet/Laplace smoothing pseudo-count
+                sparse - whether to store sparse CPTs
+                **kwargs - any other arguments to pandas.read_csv, e.g. index_col
+        OUTPUT: a BayesNet with the nodes and interactions. Rows with missing values are skipped
+        """
+        import pandas as pd
+
+        print 'Streaming node and interaction data from csv file....'
+        levels = {}
+        counts = {}
+        records = {} ### with sparse, distinct records of each family and the number of times each was seen
+        for chunk in pd.read_csv(csv_file, chunksize=chunksize, **kwargs):
+            chunk = chunk.dropna().astype('int')
+            if len(chunk) == 0: continue
+            
+            for label in chunk.keys():
+                levels[label] = max(levels.get(label, 0), chunk[label].max()+1)
+            
+            for node_k, nodes in interactions.items():
+                columns = list(nodes) + [node_k]
+                if sparse and len(nodes) > 0:
+                    rows, weights = np.unique(chunk[columns].values, axis=0, return_counts=True)
+                    if node_k in records:
+                        rows, inverse = np.unique(np.concatenate([records[node_k][0], rows]), axis=0, return_inverse=True)
+                        weights = np.bincount(inverse, weights=np.concatenate([records[node_k][1], weights]))
+                    records[node_k] = (rows, weights)
+                    continue
+                shape = [levels[k] for k in columns]
+                counts[node_k] = CPT.Pad(counts.get(node_k), shape) + CPT.Counts(chunk[columns].values, shape)
+        
+        for label, lvl in levels.items():
+            self.Nodes[label] = Node()
+            self.Nodes[label].levels = int(lvl)
+        
+        if not sparse:
+            self.InteractionsFromCounts(interactions, counts, alpha)
+            return
+        cpts = {}
+        for node_k, nodes in interactions.items():
+            shape = [self.Nodes[str(k)].levels for k in nodes] + [self.Nodes[node_k].levels]
+            if node_k in records:
+                cpts[node_k] = SparseCPT.FromData(records[node_k][0], shape, alpha, records[node_k][1])
+            else:
+                cpts[node_k] = CPT.FromCounts(CPT.Pad(counts.get(node_k), shape), alpha)
+        self.__SetInteractions(interactions, cpts)
+    
+    
+    def InteractionsFromCounts( self, interactions, counts, alpha = 0.):
+        """
+        Import the interactions from tables of counts.
+
+        INPUT:  interactions - a dictionary. key=dependent node, value=list of nodes which the key is dependent on
+                counts - a dictionary. key=dependent node, value=array of counts of shape (parent levels..., levels)
+                alpha - Dirichlet/Laplace smoothing pseudo-count. Default 0 leaves all-zeros rows for unseen parent combinations
+        OUTPUT: a BayesNet with the interactions 
+        """
+        cpts = {}
+        for node_k, nodes in interactions.items():
+            shape = [self.Nodes[str(k)].levels for k in nodes] + [self.Nodes[node_k].levels]
+            cpts[node_k] = CPT.FromCounts(CPT.Pad(counts.get(node_k), shape), alpha)
+        self.__SetInteractions(interactions, cpts)
+    
+    
+    def __SetInteractions( self, interactions, cpts):
+        """
+        Set the parents, edges and CPTs of the nodes.
+
+        INPUT:  interactions - a dictionary. key=dependent node, value=list of nodes which the key is dependent on
+                cpts - a dictionary. key=dependent node, value=its CPT
+        """
         for node_k, nodes in interactions.items():
             self.Nodes[node_k].order = nodes
             self.Nodes[node_k].parents = [self.Nodes[str(k)] for k in self.Nodes[node_k].order]
             
             for n in nodes:
                 self.add_edge( self.Nodes[n], self.Nodes[node_k] )
-        
-            for comb in product(*[range(self.Nodes[v].levels) for v in self.Nodes[node_k].order]):
-                condition = ' & '.join(['(dat[\"%s\"]==%d)'%(labs,i)  for i,labs in zip(comb, self.Nodes[node_k].order) ])
-                d = dat[eval(condition)]
-                if len(d)==0:
-                    self.Nodes[node_k].cpt[comb] = np.array([0.]*self.Nodes[node_k].levels)
-                else:
-                    self.Nodes[node_k].cpt[comb] = np.array([1.*sum(d[node_k]==lvl)/len(d) for lvl in xrange(self.Nodes[node_k].levels) ])
+            
+            self.Nodes[node_k].cpt = cpts[node_k]
 
+        children = dict( (v, []) for v in self.Nodes.values() )
+        for i,j in self.edges:
+            children[i].append(j)
         for k,v in self.Nodes.iteritems():
-            self.Nodes[k].children = [ j for i,j in self.edges if i == self.Nodes[k] ]
+            v.children = children[v]
+        self.__Modified()
+    
+
+    def LearnStructure( self, dat, score = 'bic', max_parents = 3, ess = 1., alpha = 0., workers = None, max_moves = 10000):
+        """
+        Learn the interactions from a *.csv file by hill climbing (see HillClimbing) and import the nodes and the learnt 
+        interactions, in place of a hand written interactions dictionary.
+
+        INPUT:  dat - a pandas data frame with one integer column per node
+                score - 'bic' or 'bdeu'
+                max_parents - largest number of parents of a node
+                ess - equivalent sample size of the BDeu prior
+                alpha - Dirichlet/Laplace smoothing pseudo-count of the CPTs
+                workers - number of processes scoring candidate moves, None for the calling process only
+                max_moves - largest number of edge additions, deletions and reversals
+        OUTPUT: a BayesNet with the nodes and learnt interactions, and the interactions dictionary. key=dependent node, 
+                value=list of nodes which the key is dependent on
+        """
+        self.NodesFromCSV(dat)
+        labels = list(dat.keys())
+        print 'Learning interactions....'
+        search = HillClimbing( dat[labels].values, [self.Nodes[k].levels for k in labels], score, ess, max_parents )
+        parents = search.Search( max_moves, workers=workers )
+        print 'Applied %d moves, %d edges learnt'%(search.moves, sum(len(p) for p in parents))
+        
+        interactions = dict( (labels[v], [labels[p] for p in ps]) for v, ps in enumerate(parents) )
+        self.InteractionsFromCSV(interactions, dat, alpha)
+        return interactions
+    
+    
+    def update( self, batch, decay = 1.):
+        """
+        Update the CPTs estimated from data with a batch of new records. The batch counts are added to the counts kept behind 
+        each CPT and only the parent configurations seen in the batch are renormalized, so an update costs O(batch) rather 
+        than refitting the full history.
+
+        INPUT:  batch - a pandas data frame with the same columns as the data the network was built from
+                decay - exponential forgetting factor in (0,1] applied to the past counts before the batch is added
+        OUTPUT: a BayesNet with updated CPTs. For each CPT, rows with missing values in its columns or levels outside the 
+                known levels are ignored. Other columns of batch are not read
+        """
+        for name, node in self.Nodes.items():
+            if node.cpt.counts is None: continue
+            columns = list(node.order) + [name]
+            if not all(k in batch for k in columns): continue
+            ### a missing value only drops the record from the families of its column, as in InteractionsFromCSV
+            node.cpt.Update(batch[columns].dropna().astype('int').values, decay)
+        self.__Modified()
     
 
     def GraphFromAdjList(self, adj_list ):
@@ -101,8 +308,10 @@ class BayesNet():
         OUTPUT: a graph that now has interactions loaded
         """
 
+        rows = {}
         for files in glob.glob(folder+'*.txt'):
             node = files.split('/')[-1][0]
+            rows[node] = {}
             
             for line in open(files,'r').readlines():
                 levels = re.findall('LEVELS=[0-9]*',line)
@@ -118,47 +327,767 @@ class BayesNet():
                     dat = inter[0].split(':')
                     inputs = np.array(dat[0].split(' ') ).astype('int')
                     interactions = dat[1]
-                    self.Nodes[node].cpt[ tuple(inputs) ] = np.array(interactions.split(',')).astype('float')
+                    rows[node][ tuple(inputs) ] = np.array(interactions.split(',')).astype('float')
+        
+        ### levels of the parents are only known once every file is read
+        for node, cpt_rows in rows.items():
+            if len(cpt_rows) == 0: continue
+            if self.Nodes[node].levels == 0:
+                self.Nodes[node].levels = len(next(iter(cpt_rows.values())))
+            shape = [p.levels for p in self.Nodes[node].parents] + [self.Nodes[node].levels]
+            self.Nodes[node].cpt = CPT.FromDict(cpt_rows, shape)
+        self.__Modified()
+
+
+    def SaveBinary( self, path):
+        """
+        Save the network to a single binary file that LoadBinary can memory map. The file holds a magic string, the length
+        of a JSON header (node names, parents of each node in CPT axis order, CPT shapes and block offsets), the header, then
+        64 byte aligned blocks of little endian data: the levels of each node (int64), the edges as (source, target) node
+        numbers (int64) and the CPTs back to back (float64). Nodes are numbered in sorted name order.
+
+        The counts kept behind CPTs estimated from data are not saved, so a loaded network cannot be updated.
+
+        INPUT:  path - path to the output file
+        """
+        names = sorted(self.Nodes)
+        ids = dict( (self.Nodes[k], i) for i, k in enumerate(names) )
+        nodes = [self.Nodes[k] for k in names]
+
+        levels = np.array([n.levels for n in nodes], dtype='<i8')
+        edges = np.array([[ids[i], ids[j]] for i,j in self.edges], dtype='<i8').reshape(-1, 2)
+        shapes = [None if n.cpt.table is None else list(n.cpt.table.shape) for n in nodes]
+        sizes = [0 if s is None else int(np.prod(s)) for s in shapes]
+
+        align = lambda x: -(-x // 64) * 64
+        header = {'format': 1, 'names': names, 'parents': [[ids[p] for p in n.parents] for n in nodes], 'shapes': shapes}
+        ### block offsets are relative to the end of the header, which is padded to 64 bytes
+        header['levels'] = 0
+        header['edges'] = align(levels.nbytes)
+        header['cpts'] = align(header['edges'] + edges.nbytes)
+        header['n_edges'] = len(edges)
+        header['cpt_offsets'] = np.cumsum([0] + sizes).tolist()
+
+        blob = json.dumps(header).encode('utf-8')
+        start = align(len(_MAGIC) + 8 + len(blob))
+        with open(path, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(np.array([len(blob)], dtype='<u8').tobytes())
+            f.write(blob)
+            for pos, arr in [(header['levels'], levels), (header['edges'], edges)]:
+                f.write(b'\0' * (start + pos - f.tell()))
+                f.write(arr.tobytes())
+            f.write(b'\0' * (start + header['cpts'] - f.tell()))
+            for n in nodes:
+                if n.cpt.table is not None:
+                    f.write(np.ascontiguousarray(n.cpt.table, dtype='<f8').tobytes())
+
+
+    def LoadBinary( self, path, mmap = True):
+        """
+        Load a network saved with SaveBinary. With mmap the file is opened with np.memmap and each CPT table is a read only
+        view into the mapping, so loading does not copy the CPTs and pages are read from disk on first use. Node.order
+        holds the parent names.
+
+        INPUT:  path - path to the file
+                mmap - whether to memory map the file rather than read it into memory
+        OUTPUT: a BayesNet with the nodes and interactions of the file
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError('%s is not a BayesNet binary file' % path)
+            size = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(size).decode('utf-8'))
+        start = -(-(len(_MAGIC) + 8 + size) // 64) * 64
+
+        data = np.memmap(path, dtype=np.uint8, mode='r') if mmap else np.fromfile(path, dtype=np.uint8)
+        block = lambda pos, dtype, count: data[start+pos : start+pos+8*count].view(dtype)
+
+        names = [k if isinstance(k, str) else k.encode('utf-8') for k in header['names']]
+        levels = block(header['levels'], '<i8', len(names))
+        edges = block(header['edges'], '<i8', 2*header['n_edges']).reshape(-1, 2)
+        cpts = block(header['cpts'], '<f8', header['cpt_offsets'][-1])
+
+        nodes = []
+        for k, lvl in zip(names, levels):
+            self.Nodes[k] = Node()
+            self.Nodes[k].levels = int(lvl)
+            nodes.append(self.Nodes[k])
+
+        for n, parents, shape, lo, hi in zip(nodes, header['parents'], header['shapes'], header['cpt_offsets'][:-1], header['cpt_offsets'][1:]):
+            n.order = [names[p] for p in parents]
+            n.parents = [nodes[p] for p in parents]
+            if shape is not None:
+                n.cpt = CPT(cpts[lo:hi].reshape(shape))
+
+        children = dict( (n, []) for n in nodes )
+        for i, j in edges:
+            self.edges.append((nodes[i], nodes[j]))
+            children[nodes[i]].append(nodes[j])
+        for n in nodes:
+            n.children = children[n]
+        self.__Modified()
+
+
+    def Compile(self):
+        """
+        Compile the graph into an integer indexed representation. Nodes and edges are numbered, the messages of each edge 
+        get an offset into one flat buffer, and each node gets the edge numbers of the links to its parents and children.
+        Each edge also gets the CPT axis of its source in the CPT of its target, the axis kept when its up message is 
+        computed, and each node the list of messages it sends.
+
+        The compiled representation is dropped whenever add_edge or a loader changes the network, and rebuilt on the next 
+        call to InitializeGraphMsgs or BeliefPropagation.
+        """
+        self.node_list = [self.Nodes[k] for k in sorted(self.Nodes)]  ### node instances by node number
+        self.node_ids = dict( (n, i) for i, n in enumerate(self.node_list) )
+        self.edge_ids = dict( (edge, e) for e, edge in enumerate(self.edges) )
+        self.edge_src = np.array([ self.node_ids[i] for i,j in self.edges ], dtype=int)
+        self.edge_dst = np.array([ self.node_ids[j] for i,j in self.edges ], dtype=int)
+        self.offsets = np.cumsum([0] + [ i.levels for i,j in self.edges ]).astype(int)
+        self.parent_edges = [ [self.edge_ids[(k, n)] for k in n.parents] for n in self.node_list ]
+        self.child_edges = [ [self.edge_ids[(n, k)] for k in n.children] for n in self.node_list ]
+        
+        self.edge_pos = np.zeros(len(self.edges), dtype=int)   ### axis of the source node in the CPT of the target node
+        for n, edges in enumerate(self.parent_edges):
+            self.edge_pos[edges] = np.arange(len(edges))
+        
+        self.sent_msgs = [ [ (0, e) for e in self.child_edges[n] ] + [ (1, e) for e in self.parent_edges[n] ] for n in xrange(len(self.node_list)) ]
+        self.__CompileSchedule()
+        self.compiled = True
+    
+    
+    def __CompileSchedule(self):
+        """
+        Detect whether the graph is a polytree (its undirected version is a forest) and, if so, build the two-pass message 
+        schedule. Each tree is rooted at its first node: the upward pass sends the messages towards the root from the deepest 
+        nodes first, the downward pass sends the messages away from the root in breadth first order. A message is a pair 
+        (up, e), the up or down message on edge number e.
+        """
+        N, E = len(self.node_list), len(self.edges)
+        links = [ [(e, self.edge_src[e], 1) for e in self.parent_edges[n]] + [(e, self.edge_dst[e], 0) for e in self.child_edges[n]]
+                  for n in xrange(N) ] ### (edge, neighbour, whether the message to the neighbour is an up message)
+        
+        order, tree_parent, seen = [], [None]*N, [False]*N
+        for r in xrange(N):
+            if seen[r]: continue
+            seen[r] = True
+            queue = [r]
+            for n in queue:
+                order.append(n)
+                for e, k, up in links[n]:
+                    if not seen[k]:
+                        seen[k] = True
+                        tree_parent[k] = (1-up, e)
+                        queue.append(k)
+        
+        ### a forest has exactly one edge per non-root node
+        self.polytree = E == sum(1 for t in tree_parent if t is not None)
+        self.tree_order = order ### breadth first order of the nodes in the spanning forest
+        
+        upward = [ tree_parent[n] for n in reversed(order) if tree_parent[n] is not None ]
+        downward = [ (1-up, e) for up, e in reversed(upward) ]
+        self.tree_schedule = upward + downward
     
     
     def InitializeGraphMsgs(self):
         """
-        Initialize the Bayesian network messages to random values. 
+        Initialize the Bayesian network messages to random values. Messages are stored in a pair of preallocated flat 
+        buffers (current and next iteration) for each direction.
         """
-
-        for u,v in self.edges:
-            self.m_down[ (u, v) ] = np.random.rand( u.levels )
-            self.m_up[ (u, v) ] = np.random.rand( u.levels )
-            
-            self.m_down[ (u,v) ] = self.__NormalizeMsg( self.m_down[(u,v)] )
-            self.m_up[ (u,v) ] = self.__NormalizeMsg( self.m_up[(u,v)] )
+        self.Compile()
+        self.calibrated = False
+        size = self.offsets[-1]
+        
+        self.m_down = Messages(np.empty( size, dtype=self.dtype ), self.offsets, self.edge_ids)
+        self.m_up = Messages(np.empty( size, dtype=self.dtype ), self.offsets, self.edge_ids)
+        self.__spare = ( np.empty( size, dtype=self.dtype ), np.empty( size, dtype=self.dtype ) )
+        
+        for e in xrange(len(self.edges)):
+            for msgs in [self.m_down, self.m_up]:
+                msg = np.random.rand( self.offsets[e+1]-self.offsets[e] )
+                msgs.Edge(e)[:] = self.__ToDomain( msg/np.sum(msg) )
     
     
-    def BeliefPropagation( self, MaxIter=1000, tol=1e-4 ):
+    def BeliefPropagation( self, MaxIter=1000, tol=1e-4, schedule=None, executor=None, workers=None, warm_start=True,
+                           observer=None, profile=False, verbose=True ):
         """
         Update messages iteratively for MaxIter number of times till the change in messages is less than the tolerance tol. 
-        On each iteration, the algorithm goes through the edges of the graph randomly and 1) updates all the downstream messages
-        using the messages from the previous iteration 2) updates all the upstream messages using messages from the previous iteration.
-        The converged set of messages are used to compute the node beliefs.
+        The converged set of messages are used to compute the node beliefs. The order of the message updates is set by schedule:
+            'flooding' - on each iteration, the algorithm goes through the edges of the graph and 1) updates all the downstream messages
+                         using the messages from the previous iteration 2) updates all the upstream messages using messages from the previous iteration.
+                         New messages are written into the spare message buffers, which are swapped with the current ones after the iteration.
+            'two-pass' - on a polytree, one upward and one downward pass in topological order give the exact messages.
+            'residual' - the message that would change the most is updated first, till no message would change by more than tol.
+                         MaxIter bounds the number of updates to MaxIter times the number of messages.
+        The default schedule is 'two-pass' on polytrees and 'residual' otherwise, or 'flooding' if an executor is given.
+
+        Within a flooding iteration every message only depends on the previous iteration, so the edges can be split across
+        workers, the iteration ending once every worker is done. executor sets how:
+            'serial' or None - in the calling thread
+            'thread' - on a pool of threads
+            'process' - on a pool of forked processes, with the messages in shared memory
+            or any object with a map method running the work in the memory of the calling process, e.g. a ThreadPool
+        workers is the number of workers the edges are split across, by default the number of cores.
+
+        With warm_start, once the network has been calibrated only the nodes whose evidence changed since (through AddEvidence 
+        or RemovePrior) are re-propagated: their messages are updated first and the changes spread outward in residual order, 
+        stopping where messages change by less than tol. The other messages and beliefs are reused. This applies when no 
+        schedule or executor is given.
+
+        If a cache is enabled (see EnableCache) and the current evidence set was calibrated before, the stored beliefs are 
+        used and nothing is propagated.
+
+        The call returns a BPResult with the residual of each step. With profile, the result also holds the number of 
+        message updates and time spent on each edge and the CPT contraction time of each node, see BPResult.SlowestNodes. 
+        An Observer given as observer is called as the propagation runs. verbose prints the progress messages.
 
         Note: this can be run on loopy graphs as a heuristic.
         """
-        ### TODO: parallel implemntation. Take as inputs a set of workers to map to.....
-        print 'Running belief propagation algorithm to compute marginal probabilities...'
+        if not self.compiled: self.InitializeGraphMsgs()
+        versions = self.__CPTVersions()
+        if versions != self.__cpt_versions:
+            ### a CPT was edited in place, e.g. through its dictionary view, since the last calibration
+            self.calibrated = False
+            self.__cpt_versions = versions
+            if self.cache is not None: self.cache.Clear()
+        
+        result = BPResult( sorted(self.Nodes), len(self.edges), profile )
+        self.__result, self.__observer, self.__verbose = result, observer, verbose
+        start = time.time()
+        try:
+            key = None
+            if self.cache is not None:
+                key = BeliefCache.Key( (self.version, self.log_domain), dict( (k, n.evidence) for k, n in self.Nodes.items() if len(n.evidence)>0 ) )
+                if self.__FromCache(key):
+                    result.schedule, result.converged = 'cache', True
+                    self.__Print( 'Beliefs restored from cache' )
+            
+            if result.schedule is None and self.__Calibrate( MaxIter, tol, schedule, executor, workers, warm_start ) and key is not None:
+                self.__ToCache(key)
+        finally:
+            result.seconds = time.time() - start
+            self.__result, self.__observer, self.__verbose = None, None, True
+        
+        if observer is not None: observer.OnFinish(result)
+        return result
+    
+    
+    def __Print( self, message ):
+        if self.__verbose: print message
+    
+    
+    def __Start( self, schedule ):
+        """
+        Record the schedule of the running BeliefPropagation call and notify its observer.
+        """
+        if self.__result is None: return
+        self.__result.schedule = schedule
+        if self.__observer is not None: self.__observer.OnStart(self, self.__result)
+    
+    
+    def __Step( self, step, residual ):
+        """
+        Record the residual of a step of the running BeliefPropagation call and notify its observer.
+        """
+        if self.__result is None: return
+        self.__result.residuals.append(residual)
+        if self.__observer is not None: self.__observer.OnStep(self.__result, step, residual)
+    
+    
+    def EnableCache( self, max_bytes=64*2**20, messages=False ):
+        """
+        Keep the beliefs calibrated by BeliefPropagation in a least recently used cache keyed by the evidence set, so that 
+        repeated evidence sets are not propagated again. The cache is cleared whenever the structure or CPTs change. Hit, 
+        miss and eviction counts are given by self.cache.Stats().
+
+        INPUT:  max_bytes - memory cap of the cached arrays
+                messages - whether to also cache the messages, so that warm starts can follow a cache hit
+        """
+        self.cache = BeliefCache( max_bytes, messages )
+    
+    
+    def __FromCache( self, key ):
+        """
+        Restore the beliefs, and messages if cached, calibrated for a key. Returns whether the key was found.
+        """
+        arrays = self.cache.Get(key)
+        if arrays is None: return False
+        
+        N = len(self.node_list)
+        for node, beliefs in zip(self.node_list, arrays[:N]):
+            node.beliefs = beliefs.copy()
+        if len(arrays) > N:
+            self.m_down.buf[...], self.m_up.buf[...] = arrays[N:]
+            self.calibrated, self.changed = True, set()
+        else:
+            self.calibrated = False
+        return True
+    
+    
+    def __ToCache( self, key ):
+        arrays = [ np.asarray(node.beliefs) for node in self.node_list ]
+        if self.cache.messages:
+            arrays += [ self.m_down.buf, self.m_up.buf ]
+        self.cache.Put(key, arrays)
+    
+    
+    def __Calibrate( self, MaxIter, tol, schedule, executor, workers, warm_start ):
+        """
+        Run belief propagation, see BeliefPropagation. Returns whether the messages converged.
+        """
+        if warm_start and self.calibrated and schedule is None and executor in (None, 'serial'):
+            return self.__WarmStartBP( MaxIter, tol )
+        if schedule is None: schedule = 'flooding' if executor not in (None, 'serial') else 'two-pass' if self.polytree else 'residual'
+        
+        self.__Start( schedule )
+        self.__Print( 'Running belief propagation algorithm to compute marginal probabilities...' )
+        if schedule == 'flooding':
+            update, close = self.__Executor( executor, workers )
+            try:
+                steps = self.__FloodingBP( MaxIter, tol, update )
+            finally:
+                close()
+        else:
+            steps = self.__Propagate( MaxIter, tol, schedule )
+        if steps is None:
+            if schedule == 'two-pass':
+                self.__Print( 'Messages are not finite after the upward and downward passes. Beliefs not computed.' )
+            else:
+                self.__Print( 'Did not converge in %d steps with tolerance %1.6f. Beliefs not computed.'%(MaxIter,tol) )
+            self.calibrated = False
+            return False
+        
+        self.GetBeliefs()
+        self.calibrated, self.changed = True, set()
+        self.__result.converged, self.__result.steps = True, steps
+        if schedule == 'two-pass':
+            self.__Print( 'Converged in one upward and one downward pass. Beliefs computed' )
+        elif schedule == 'residual':
+            self.__Print( 'Converged in %d message updates. Beliefs computed'%steps )
+        else:
+            self.__Print( 'Converged in %d steps. Beliefs computed'%steps )
+        return True
+    
+    
+    def query_batch( self, evidence_list, MaxIter=1000, tol=1e-4, schedule=None ):
+        """
+        Compute the node beliefs for many evidence sets at once. All the messages and CPT contractions carry a leading batch 
+        axis, one entry per evidence set, so that the scenarios are propagated together. Polytrees use the two-pass schedule, 
+        loopy graphs flooding till every scenario has converged. Node.evidence, Node.beliefs and the messages of the network
+        are left untouched.
+
+        INPUT:  evidence_list - list of dictionaries as given to AddEvidence. keys=node names, values = probability distributions.
+                MaxIter, tol - as in BeliefPropagation
+                schedule - 'two-pass' or 'flooding'. Default is 'two-pass' on polytrees and 'flooding' otherwise
+        OUTPUT: array of beliefs of shape (batch, node, level). Nodes are in the order of sorted node names, levels beyond 
+                the levels of a node are zero
+        """
+        if not self.compiled: self.InitializeGraphMsgs()
+        if schedule is None: schedule = 'two-pass' if self.polytree else 'flooding'
+        
+        saved = self.__SetBatch( evidence_list )
+        try:
+            if self.__Propagate( MaxIter, tol, schedule ) is None:
+                print 'Did not converge in %d steps with tolerance %1.6f.'%(MaxIter,tol)
+            
+            beliefs = np.zeros((len(evidence_list), len(self.node_list), max([n.levels for n in self.node_list] or [0])))
+            for n, node in enumerate(self.node_list):
+                beliefs[:, n, :node.levels] = self.__Beliefs(n)
+        finally:
+            self.__RestoreBatch( saved )
+        return beliefs
+    
+    
+    def predict_proba( self, df, target, batch=1000, MaxIter=1000, tol=1e-4, schedule=None ):
+        """
+        Posterior distribution of target nodes for each row of a data frame. The other columns naming nodes are hard 
+        evidence, missing values or levels outside the levels of a node leave the node unobserved. Rows with the same 
+        evidence are computed once, the distinct evidence patterns being propagated batch at a time with query_batch.
+
+        INPUT:  df - a pandas data frame with columns named as in NodesFromCSV
+                target - node name, or list of node names
+                batch - number of distinct evidence patterns propagated together
+                MaxIter, tol, schedule - as in query_batch
+        OUTPUT: array of shape (rows, levels) of the posterior of the target for each row, or for a list of targets a 
+                dictionary. key=node name, value=array of shape (rows, levels)
+        """
+        single = isinstance(target, basestring)
+        targets = [target] if single else list(target)
+        columns = [k for k in df.keys() if k in self.Nodes and k not in targets]
+        if not self.compiled: self.InitializeGraphMsgs()
+        
+        ### one row per data row, -1 where a node is unobserved
+        codes = df[columns].values.astype(float)
+        levels = np.array([self.Nodes[k].levels for k in columns])
+        codes[~np.isfinite(codes)] = -1
+        codes = np.where((codes >= 0) & (codes < levels), codes, -1).astype(int)
+        if len(df) == 0:
+            patterns, inverse = np.zeros((0, len(columns)), dtype=int), np.zeros(0, dtype=int)
+        elif len(columns) == 0:
+            ### no observed node, every row is the same empty evidence pattern
+            patterns, inverse = np.zeros((1, 0), dtype=int), np.zeros(len(df), dtype=int)
+        else:
+            patterns, inverse = np.unique(codes, axis=0, return_inverse=True)
+        
+        index = dict( (k, n) for n, k in enumerate(sorted(self.Nodes)) )
+        posteriors = dict( (k, np.zeros((len(patterns), self.Nodes[k].levels))) for k in targets )
+        eye = [np.eye(l) for l in levels]
+        for lo in xrange(0, len(patterns), batch):
+            evidence_list = [ dict( (columns[c], eye[c][v]) for c, v in enumerate(row) if v >= 0 ) for row in patterns[lo:lo+batch] ]
+            beliefs = self.query_batch( evidence_list, MaxIter, tol, schedule )
+            for k in targets:
+                posteriors[k][lo:lo+batch] = beliefs[:, index[k], :self.Nodes[k].levels]
+        
+        if single: return posteriors[target][inverse]
+        return dict( (k, p[inverse]) for k, p in posteriors.items() )
+    
+    
+    def __SetBatch( self, evidence_list ):
+        """
+        Replace the messages of the network by one copy per evidence set, see query_batch.
+
+        OUTPUT: the state to give to __RestoreBatch
+        """
+        B = len(evidence_list)
+        evidence = []
+        for node in self.node_list:
+            ev, observed = np.zeros((B, node.levels)), np.zeros(B, dtype=bool)
+            evidence.append( (ev, observed) )
+        index = dict( (k, n) for n, k in enumerate(sorted(self.Nodes)) )
+        for b, node_state_dict in enumerate(evidence_list):
+            for k, v in node_state_dict.items():
+                evidence[index[k]][0][b] = np.asarray(v, dtype=float)/np.sum(v)
+                evidence[index[k]][1][b] = True
+        evidence = [ (self.__ToDomain(ev), observed) for ev, observed in evidence ]
+        
+        saved = ( self.m_down.buf, self.m_up.buf, self.__spare, self.__batch_evidence )
+        ### every scenario starts from the current messages of the network
+        self.m_down.buf, self.m_up.buf = np.tile(saved[0], (B, 1)), np.tile(saved[1], (B, 1))
+        self.__spare = ( np.empty_like(self.m_down.buf), np.empty_like(self.m_up.buf) )
+        self.__batch_evidence = evidence
+        return saved
+    
+    
+    def __RestoreBatch( self, saved ):
+        self.m_down.buf, self.m_up.buf, self.__spare, self.__batch_evidence = saved
+    
+    
+    def MAP( self, evidence_list=None, MaxIter=1000, tol=1e-4, schedule=None ):
+        """
+        Most probable joint assignment of the nodes given the evidence, for many evidence sets at once. Messages are 
+        propagated as in query_batch with the max-product rule, a maximum in place of the sum over the levels of the other 
+        nodes of a CPT. The assignment is then backtracked: the nodes are assigned one at a time in breadth first order of 
+        the compiled spanning forest, each to the level maximizing its max-marginal given the levels of the assigned nodes 
+        it shares a CPT with. This is exact on polytrees and a heuristic on loopy graphs.
+
+        INPUT:  evidence_list - list of dictionaries as given to AddEvidence, None for the evidence set in the nodes
+                MaxIter, tol, schedule - as in query_batch
+        OUTPUT: integer array of shape (batch, node) of the level of each node, nodes in the order of sorted node names. 
+                Without evidence_list, a dictionary. key=node name, value=level
+        """
+        if not self.compiled: self.InitializeGraphMsgs()
+        if schedule is None: schedule = 'two-pass' if self.polytree else 'flooding'
+        single = evidence_list is None
+        if single: evidence_list = [ dict( (k, n.evidence) for k, n in self.Nodes.items() if len(n.evidence)>0 ) ]
+        
+        saved = self.__SetBatch( evidence_list )
+        self.__max_product = True
+        try:
+            if self.__Propagate( MaxIter, tol, schedule ) is None:
+                print 'Did not converge in %d steps with tolerance %1.6f. Assignment decoded from the last messages.'%(MaxIter,tol)
+            levels = self.__Backtrack( len(evidence_list) )
+        finally:
+            self.__max_product = False
+            self.__RestoreBatch( saved )
+        
+        if single: return dict( (k, int(levels[0, n])) for n, k in enumerate(sorted(self.Nodes)) )
+        return levels
+    
+    
+    def __Backtrack( self, B ):
+        """
+        Decode the assignment of each of B evidence sets from max-product messages, see MAP.
+        """
+        levels = np.zeros((B, len(self.node_list)), dtype=int)
+        assigned = np.zeros(len(self.node_list), dtype=bool)
+        
+        def clamp(k):
+            onehot = np.zeros((B, self.node_list[k].levels))
+            onehot[np.arange(B), levels[:, k]] = 1.
+            return self.__ToDomain(onehot)
+        
+        for n in self.tree_order:
+            node = self.node_list[n]
+            ### children side: messages from unassigned children, the CPT of an assigned child with its assigned nodes clamped
+            merged = self.__ToDomain( np.ones((B, node.levels)) )
+            for e in self.child_edges[n]:
+                c = self.edge_dst[e]
+                if assigned[c]:
+                    msgs = [ None if k == e else clamp(self.edge_src[k]) if assigned[self.edge_src[k]] else self.m_down.Edge(k) for k in self.parent_edges[c] ]
+                    msg = self.__Contract( self.node_list[c], msgs, child=clamp(c), keep=(self.edge_pos[e],) )
+                else:
+                    msg = self.m_up.Edge(e)
+                merged = self.__Combine( merged, msg )
+            evidence, observed = self.__batch_evidence[n]
+            merged = np.where(observed[:,None], evidence, merged)
+            
+            if len(node.cpt) > 0:
+                msgs = [ clamp(self.edge_src[e]) if assigned[self.edge_src[e]] else self.m_down.Edge(e) for e in self.parent_edges[n] ]
+                score = self.__Contract( node, msgs, child=merged )
+            else:
+                score = merged
+            levels[:, n] = np.argmax(score, axis=-1)
+            assigned[n] = True
+        return levels
+    
+    
+    def __Propagate( self, MaxIter, tol, schedule ):
+        """
+        Run the message updates of the given schedule.
+
+        OUTPUT: number of steps to convergence, None if the messages did not converge
+        """
+        if schedule == 'two-pass':
+            return self.__TwoPassBP()
+        if schedule == 'residual':
+            return self.__ResidualBP( MaxIter, tol )
+        return self.__FloodingBP( MaxIter, tol )
+    
+    
+    def __FloodingBP( self, MaxIter, tol, update=None ):
+        """
+        Synchronous belief propagation: every message of an iteration is computed from the messages of the previous one.
+
+        INPUT:  update - function writing all the new messages into a pair of (down, up) buffers, see __Executor
+        """
         for iteration in xrange(MaxIter):
             
-            new_up = dict([ ((i,j) , self.__UpdateUpMsgs(i,j)) for i,j in np.random.permutation( self.edges ) ])
-            new_down = dict([ ((i,j), self.__UpdateDownMsgs(i,j)) for i,j in np.random.permutation( self.edges ) ])
+            new_down, new_up = self.__spare
+            if update is None:
+                self.UpdateMsgs(0, len(self.edges), new_down, new_up)
+            else:
+                update(new_down, new_up)
             
-            if self.__MessageDifference(new_down, new_up) < tol:
-                self.GetBeliefs()
-                print 'Converged in %d steps. Beliefs computed'%iteration
-                return
+            residual = self.__MessageDifference(new_down, new_up)
+            self.__Step( iteration, residual )
+            if residual < tol:
+                return iteration
             else:
-                self.m_up = new_up.copy()
-                self.m_down = new_down.copy()
-        print 'Did not converge in %d steps with tolerance %1.6f. Beliefs not computed.'%(iteration,tol)
-        return
+                self.__spare = ( self.m_down.buf, self.m_up.buf )
+                self.m_down.buf, self.m_up.buf = new_down, new_up
+        return None
+    
+    
+    def UpdateMsgs( self, lo, hi, new_down, new_up ):
+        """
+        Compute from the current messages the new up and down messages of the edges numbered lo to hi-1.
+
+        INPUT:  lo, hi - range of edge numbers
+                new_down, new_up - message buffers receiving the new messages
+        """
+        for e in xrange(lo, hi):
+            new_up[ ..., self.offsets[e]:self.offsets[e+1] ] = self.__NewMsg(1, e)
+            new_down[ ..., self.offsets[e]:self.offsets[e+1] ] = self.__NewMsg(0, e)
+    
+    
+    def __Partition( self, parts ):
+        """
+        Split the edges into at most parts contiguous ranges of about equal cost, the cost of an edge being the size of 
+        the CPTs contracted to update its two messages.
+        """
+        cost = np.cumsum([ max(len(i.cpt),1)*i.levels + max(len(j.cpt),1)*j.levels for i,j in self.edges ])
+        bounds = [0] + list(np.searchsorted(cost, np.linspace(0, cost[-1], parts+1)[1:-1])) + [len(self.edges)]
+        return [ (lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo ]
+    
+    
+    def __Executor( self, executor, workers ):
+        """
+        Set up the workers of the flooding schedule.
+
+        OUTPUT: update - function writing all the new messages into a pair of (down, up) buffers, None to run serially
+                close - function releasing the workers
+        """
+        if executor in (None, 'serial') or len(self.edges) == 0:
+            return None, lambda: None
+        
+        chunks = self.__Partition( workers or multiprocessing.cpu_count() )
+        if executor != 'process':
+            pool = ThreadPool( workers or multiprocessing.cpu_count() ) if executor == 'thread' else executor
+            def update(new_down, new_up):
+                pool.map( lambda chunk: self.UpdateMsgs(chunk[0], chunk[1], new_down, new_up), chunks )
+            def close():
+                if executor == 'thread':
+                    pool.close()
+                    pool.join()
+            return update, close
+        
+        ### move the message buffers into shared memory before the workers are forked
+        shared = []
+        for current in [self.m_down.buf, self.m_up.buf]:
+            buf = np.frombuffer(multiprocessing.RawArray('b', 2*current.nbytes), dtype=current.dtype).reshape((2,) + current.shape)
+            buf[0] = current
+            shared.append( [buf[0], buf[1]] )
+        down, up = shared
+        self.m_down.buf, self.m_up.buf = down[0], up[0]
+        self.__spare = ( down[1], up[1] )
+        
+        _shared.update( graph=self, down=down, up=up )
+        pool = multiprocessing.Pool( workers or multiprocessing.cpu_count() )
+        def update(new_down, new_up):
+            new = 1 if new_down is down[1] else 0
+            pool.map( _UpdateMsgsWorker, [ (lo, hi, new) for lo, hi in chunks ] )
+        def close():
+            pool.close()
+            pool.join()
+            _shared.clear()
+        return update, close
+    
+    
+    def __TwoPassBP( self ):
+        """
+        Exact belief propagation on a polytree: every message is computed once, in the order of the compiled tree schedule.
+        Returns None if a message is not finite.
+        """
+        if not self.polytree:
+            raise ValueError('The two-pass schedule requires a polytree')
+        
+        for up, e in self.tree_schedule:
+            self.__SendMsg(up, e)
+        
+        ### e.g. linear domain messages underflowing to all-zeros on nodes with many children
+        for buf in (self.m_down.buf, self.m_up.buf):
+            finite = np.isfinite(buf)
+            if self.log_domain: finite |= buf == -np.inf ### levels of zero probability
+            if not finite.all(): return None
+        return 1
+    
+    
+    def __WarmStartBP( self, MaxIter, tol ):
+        """
+        Re-propagate a calibrated network from the nodes whose evidence changed, and update the beliefs of the nodes 
+        reached by a changed message.
+        """
+        self.__Start( 'residual' )
+        self.__Print( 'Running belief propagation algorithm to compute marginal probabilities...' )
+        changed = [ self.node_ids[n] for n in self.changed ]
+        touched = set(changed)
+        steps = self.__ResidualBP( MaxIter, tol, seeds=[ m for n in changed for m in self.sent_msgs[n] ], touched=touched )
+        if steps is None:
+            self.__Print( 'Did not converge in %d message updates with tolerance %1.6f. Beliefs not computed.'%(MaxIter*2*len(self.edges),tol) )
+            self.calibrated = False
+            return False
+        
+        for n in touched:
+            self.node_list[n].beliefs = self.__Beliefs(n)
+        self.changed = set()
+        self.__result.converged, self.__result.steps = True, steps
+        self.__Print( 'Converged in %d message updates from %d changed nodes. Beliefs computed'%(steps, len(changed)) )
+        return True
+    
+    
+    def __ResidualBP( self, MaxIter, tol, seeds=None, touched=None ):
+        """
+        Residual belief propagation: the candidate value of every message is kept in the spare buffers along with its 
+        residual, the change it would make. The message with the largest residual is committed first and the candidates 
+        of the messages that depend on it are recomputed.
+
+        INPUT:  seeds - (up, e) messages whose candidates are computed first, None for all messages
+                touched - set collecting the numbers of the nodes receiving a committed message
+        """
+        E = len(self.edges)
+        candidates = self.__spare
+        residual = np.zeros((2, E))
+        version = np.zeros((2, E), dtype=int)
+        heap = []
+        
+        def refresh(up, e):
+            new_msg = self.__NewMsg(up, e)
+            candidates[up][ ..., self.offsets[e]:self.offsets[e+1] ] = new_msg
+            residual[up, e] = np.sqrt(self.__SquaredDistance(new_msg, self.__Msgs(up).Edge(e))).max()
+            version[up, e] += 1
+            heapq.heappush(heap, (-residual[up, e], version[up, e], up, e))
+        
+        if seeds is None:
+            seeds = [ (up, e) for e in xrange(E) for up in (0, 1) ]
+        for up, e in seeds:
+            refresh(up, e)
+        
+        updates = 0
+        while heap:
+            r, v, up, e = heapq.heappop(heap)
+            if v != version[up, e]: continue
+            if -r < tol: break
+            if updates == MaxIter*2*E: return None
+            
+            self.__Msgs(up).Edge(e)[...] = candidates[up][ ..., self.offsets[e]:self.offsets[e+1] ]
+            residual[up, e] = 0.
+            updates += 1
+            self.__Step( updates, -r )
+            
+            receiver = self.edge_src[e] if up else self.edge_dst[e]
+            if touched is not None: touched.add(receiver)
+            for up_k, k in self.sent_msgs[ receiver ]:
+                if k != e: refresh(up_k, k)
+        return updates
+    
+    
+    def ExactInference( self, heuristic='min-fill' ):
+        """
+        Compute the exact node beliefs given the evidence with the junction tree algorithm. Unlike BeliefPropagation this 
+        is exact on loopy graphs. The junction tree is compiled on first use and reused for later evidence sets until the 
+        structure or the CPTs of the network change, including CPTs edited in place.
+
+        INPUT:  heuristic - elimination ordering used to triangulate the moral graph, 'min-fill' or 'min-degree'
+        OUTPUT: A Bayesian network with updated beliefs for the nodes of the network
+        """
+        versions = self.__CPTVersions()
+        if self.junction_tree is None or self.junction_tree.heuristic != heuristic or versions != self.__jt_versions:
+            self.junction_tree = JunctionTree(self, heuristic)
+            self.__jt_versions = versions
+        
+        self.junction_tree.Calibrate( dict( (k, n.evidence) for k, n in self.Nodes.items() if len(n.evidence)>0 ) )
+        for k, n in self.Nodes.items():
+            n.beliefs = self.junction_tree.Marginal(k)
+        ### the beliefs no longer come from the messages, so a warm start must not reuse them
+        self.calibrated = False
+    
+    
+    def SampleBeliefs( self, method='likelihood', samples=100000, seconds=None, batch=10000, burn_in=100, seed=None ):
+        """
+        Estimate the node beliefs given the evidence by sampling, for networks too large for ExactInference where 
+        BeliefPropagation does not converge. Sampling stops once samples are drawn or seconds have passed, whichever comes 
+        first, so accuracy can be traded for time. See Sampler for the methods:
+            'likelihood' - likelihood weighting, batch samples drawn at a time
+            'gibbs' - Gibbs sampling with batch chains, dropping burn_in sweeps of each chain
+
+        INPUT:  method - 'likelihood' or 'gibbs'
+                samples - sample budget, None for no limit
+                seconds - time budget, None for no limit
+                batch - number of samples drawn at a time, or of chains
+                burn_in - number of Gibbs sweeps dropped
+                seed - seed or np.random.RandomState, for repeatable estimates
+        OUTPUT: A Bayesian network with estimated beliefs for the nodes of the network, and a dictionary. key=node name, 
+                value=standard error of the belief of each level
+        """
+        versions = self.__CPTVersions()
+        if self.sampler is None or versions != self.__sampler_versions:
+            self.sampler = Sampler(self)
+            self.__sampler_versions = versions
+        rng = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+        evidence = dict( (k, n.evidence) for k, n in self.Nodes.items() if len(n.evidence)>0 )
+        
+        if method == 'gibbs':
+            beliefs, stderr = self.sampler.Gibbs( evidence, samples, seconds, batch, burn_in, rng )
+            print 'Drew %d Gibbs samples. Beliefs computed'%self.sampler.samples
+        else:
+            beliefs, stderr, ess = self.sampler.LikelihoodWeighting( evidence, samples, seconds, batch, rng )
+            print 'Drew %d weighted samples, effective sample size %1.1f. Beliefs computed'%(self.sampler.samples, ess)
+        
+        for k, b in zip(self.sampler.names, beliefs):
+            self.Nodes[k].beliefs = b
+        self.calibrated = False
+        return dict( zip(self.sampler.names, stderr) )
     
 
     def GetBeliefs( self ):
@@ -168,8 +1097,22 @@ class BayesNet():
         OUTPUT: A Bayesian network with updated beliefs for the nodes of the network
         """
 
-        for i,node in self.Nodes.iteritems():
-            node.ComputeBeliefs( self.m_down, self.m_up )
+        for n,node in enumerate(self.node_list):
+            node.beliefs = self.__Beliefs(n)
+    
+    
+    def __Beliefs( self, n ):
+        """
+        Beliefs of node number n from the current messages, see Node.ComputeBeliefs.
+        """
+        node = self.node_list[n]
+        beliefs = self.__MergeUp(n)
+        if len(node.cpt) > 0:
+            beliefs = self.__Contract(node, self.__ParentMsgs(n), child=beliefs)
+        else:
+            beliefs = self.__Combine(beliefs, self.__ToDomain(np.ones(node.levels)))
+        beliefs = self.__NormalizeMsg( beliefs )
+        return np.exp(beliefs) if self.log_domain else beliefs
     
     
     def AddEvidence(self, node_state_dict):
@@ -182,6 +1125,7 @@ class BayesNet():
 
         for k,v in node_state_dict.items():
             self.Nodes[k].evidence = v/np.sum(v)
+            self.changed.add(self.Nodes[k])
     
     def RemovePrior(self, node):
         """
@@ -191,6 +1135,7 @@ class BayesNet():
         """
         for n in node.keys():
             self.Nodes[n].evidence = []
+            self.changed.add(self.Nodes[n])
     
     def add_edge(self, i, j):
         """
@@ -201,54 +1146,201 @@ class BayesNet():
         OUTPUT: a graph with a directed edge going from node i to node j
         """
         self.edges.append( (i,j) )
+        self.__Modified()
+    
     
+    def __Modified(self):
+        """
+        Invalidate the compiled representations of the network once its structure or CPTs change.
+        """
+        self.compiled = False
+        self.calibrated = False
+        self.junction_tree = None
+        self.sampler = None
+        self.version += 1
+        if self.cache is not None: self.cache.Clear()
     
     
-    def __UpdateUpMsgs(self, node_i, node_j):
+    def __CPTVersions(self):
+        """
+        Version of the CPT of each node, see CPT.version. CPTs edited in place do not go through __Modified, so the 
+        calibrated messages, cached beliefs and compiled models are checked against these.
+        """
+        return [ getattr(n.cpt, 'version', None) for n in self.Nodes.itervalues() ]
+    
+    
+    
+    def __Msgs(self, up):
+        return self.m_up if up else self.m_down
+    
+    
+    def __SendMsg(self, up, e):
+        """
+        Update in place the up or down message on edge number e.
+        """
+        self.__Msgs(up).Edge(e)[:] = self.__NewMsg(up, e)
+    
+    
+    def __NewMsg(self, up, e):
+        """
+        New up or down message on edge number e, counted and timed when the running BeliefPropagation call is profiled.
+        """
+        result = self.__result
+        if result is None or not result.profile:
+            return self.__UpdateUpMsgs(e) if up else self.__UpdateDownMsgs(e)
+        
+        start = time.time()
+        msg = self.__UpdateUpMsgs(e) if up else self.__UpdateDownMsgs(e)
+        result.edge_updates[up, e] += 1
+        result.edge_seconds[up, e] += time.time() - start
+        return msg
+    
+    
+    def __MergeUp(self, n, excluding=None):
+        """
+        Merge of the up messages coming from the children of node number n, see Node.MergeUp.
+
+        INPUT:  n - node number
+                excluding - edge number whose message is ignored
+        """
+        node = self.node_list[n]
+        if self.__batch_evidence is None and len(node.evidence)>0:
+            return self.__ToDomain(node.evidence)
+        
+        msgs = [ self.m_up.Edge(e) for e in self.child_edges[n] if e != excluding ]
+        if self.log_domain:
+            merged = np.sum(msgs or [np.zeros(node.levels)], axis=0)
+        else:
+            merged = np.product(msgs or [np.ones(node.levels)], axis=0)
+        if self.__batch_evidence is None: return merged
+        
+        evidence, observed = self.__batch_evidence[n]
+        if not observed.any(): return merged
+        return np.where(observed[:,None], evidence, merged)
+    
+    
+    def __ParentMsgs(self, n, excluding=None):
+        """
+        Down messages coming from the parents of node number n, in the order of the CPT axes, see Node.ParentMsgs.
+
+        INPUT:  n - node number
+                excluding - edge number whose message is ignored
+        """
+        return [ None if e == excluding else self.m_down.Edge(e) for e in self.parent_edges[n] ]
+    
+    
+    def __UpdateUpMsgs(self, e):
         """
         Update an upstream message. On a direct edge i -> j this is the message j ->i 
 
-        INPUT: node_i,node_j - node instances
+        INPUT: e - edge number of the edge i -> j
         OUTPUT: a normalized new message from j->i
         """
+        j = self.edge_dst[e]
+        node_j = self.node_list[j]
         
-        msgs_up = node_j.MergeUp(self.m_up)
-        
-        marginalized_down_msg = np.sum( np.multiply( msgs_up , node_j.MergeDown(self.m_down, excluding = node_i) ),axis=1 )
-        new_msg = [ [elem for key,elem in zip( node_j.cpt.keys(), marginalized_down_msg ) if key[ node_j.WhichParent( node_i )] == ii ]for ii in range( node_i.levels)]
+        msgs_up = self.__MergeUp(j)
+        new_msg = self.__Contract(node_j, self.__ParentMsgs(j, excluding = e), child = msgs_up, keep = (self.edge_pos[e],))
         
-        return self.__NormalizeMsg( np.sum(new_msg, axis=1) )
+        return self.__NormalizeMsg( new_msg )
     
     
-    def __UpdateDownMsgs(self, node_i, node_j):
+    def __UpdateDownMsgs(self, e):
         """
         Update a downstream message. On a directed edge i-> j this is the message i->j
 
-        INPUT: node_i,node_j - node instances
+        INPUT: e - edge number of the edge i -> j
         OUTPUT: a normalized new message from i->j
         """
-        msgs_up = node_i.MergeUp( self.m_up, excluding = node_j )
+        i = self.edge_src[e]
+        node_i = self.node_list[i]
+        msgs_up = self.__MergeUp( i, excluding = e )
         
-        if len(node_i.cpt.keys()) == 0:
-            marginalized_down_msg = [1.0] * node_i.levels
+        if len(node_i.cpt) == 0:
+            marginalized_down_msg = self.__ToDomain( np.ones(node_i.levels) )
         else:
-            marginalized_down_msg = np.sum( node_i.MergeDown(self.m_down),axis=0)
+            marginalized_down_msg = self.__Contract(node_i, self.__ParentMsgs(i))
+        
+        return self.__NormalizeMsg( self.__Combine(msgs_up, marginalized_down_msg) )
+    
+    
+    def __Contract(self, node, msgs, child = None, keep = (-1,)):
+        """
+        Contract the CPT of a node with messages, timed when the running BeliefPropagation call is profiled.
+        """
+        result = self.__result
+        if result is None or not result.profile:
+            return self.__ContractCPT(node, msgs, child, keep)
+        
+        start = time.time()
+        contracted = self.__ContractCPT(node, msgs, child, keep)
+        result.node_seconds[self.node_ids[node]] += time.time() - start
+        return contracted
+    
+    
+    def __ContractCPT(self, node, msgs, child, keep):
+        """
+        Contract the CPT of a node with messages, see CPT.Contract, or CPT.MaxContract in max-product mode. In the log domain 
+        each message is shifted by its maximum before being exponentiated, and the shifts are added back to the log of the 
+        contraction.
+        """
+        contract = node.cpt.MaxContract if self.__max_product else node.cpt.Contract
+        if not self.log_domain:
+            return contract(msgs, child, keep)
         
-        return self.__NormalizeMsg( np.multiply(msgs_up, marginalized_down_msg) )
+        shift = 0.
+        scaled = []
+        for m in msgs + [child]:
+            if m is None:
+                scaled.append(None)
+                continue
+            top = np.max(m, axis=-1)
+            top = np.where(np.isfinite(top), top, 0.)
+            scaled.append( np.exp(m - top[...,None]) )
+            shift = shift + top
+        with np.errstate(divide='ignore'):
+            return np.log( contract(scaled[:-1], scaled[-1], keep) ) + np.expand_dims(shift, -1)
+    
+    
+    def __Combine(self, a, b):
+        """
+        Pointwise product of two messages, a sum in the log domain.
+        """
+        return np.add(a, b) if self.log_domain else np.multiply(a, b)
+    
+    
+    def __ToDomain(self, p):
+        """
+        Convert probabilities to the domain of the messages.
+        """
+        if not self.log_domain: return p
+        with np.errstate(divide='ignore'):
+            return np.log(p)
+    
+    
+    def __SquaredDistance(self, a, b):
+        """
+        Squared L2 distance between messages as probabilities, summed over the last axis.
+        """
+        if self.log_domain: a, b = np.exp(a), np.exp(b)
+        return np.sum((a - b)**2, axis=-1)
     
     
     def __NormalizeMsg(self, msg):
         """
-        Normalize the message. Default is for probability vectors to sum to one, but can change if messages are not probabilities, i.e. log probs
+        Normalize the message. Default is for probability vectors to sum to one, in the log domain for the log probs to 
+        have a log-sum-exp of zero
         """
-        return msg/np.sum(msg)
+        if self.log_domain:
+            top = np.max(msg, axis=-1)[...,None]
+            top = np.where(np.isfinite(top), top, 0.)
+            return msg - top - np.log(np.sum(np.exp(msg - top), axis=-1))[...,None]
+        return msg/np.sum(msg, axis=-1)[...,None]
     
     
     def __MessageDifference(self, down, up ):
         """
         Computing the message differences
         """
-        delta = np.sqrt(np.sum([ np.sum((down[(i,j)] - self.m_down[(i,j)])**2) + np.sum((up[(i,j)] - self.m_up[(i,j)])**2) for i,j in self.edges ]))
-        return delta
-
-
+        delta = np.sqrt( self.__SquaredDistance(down, self.m_down.buf) + self.__SquaredDistance(up, self.m_up.buf) )
+        return np.max(delta)
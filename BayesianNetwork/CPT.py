@@ -0,0 +1,411 @@
+import itertools
+import numpy as np
+
+__all__ = ['CPT', 'SparseCPT']
+
+_versions = itertools.count(1) ### shared by all CPTs, so that a version is never reused by another table
+
+class CPT(object):
+    """
+    Dense conditional probability table of a node. The table is stored as a single contiguous array of shape
+    (parent levels..., levels), i.e. one axis per parent in the order of Node.order followed by the levels of the node itself.
+
+    The object behaves like the dictionary of parent configurations it replaces: keys are tuples of parent levels and
+    cpt[key] is a view into the corresponding row of the table. A CPT without a table (a node without parents) is empty.
+
+    A CPT estimated from data keeps the raw counts behind the table so that it can be updated with new records.
+
+    version changes whenever rows are set, updated, renormalized or allocated, so that a network can tell a CPT was edited in place.
+    """
+    def __init__(self, table = None):
+        self.table = None if table is None else np.ascontiguousarray(table, dtype=float)
+        self.version = next(_versions) ### changed by every edit of the table
+        self.counts = None ### raw counts, in units of scale, of shape table.shape
+        self.scale = 1.    ### weight of a stored count, decays with exponential forgetting
+        self.alpha = 0.    ### Dirichlet/Laplace smoothing pseudo-count
+
+
+    @classmethod
+    def FromDict(cls, rows, shape):
+        """
+        Build a dense CPT from a dictionary of rows.
+
+        INPUT:  rows - dictionary. key=tuple of parent levels, value=probability of each level of the node
+                shape - tuple of the parent levels followed by the levels of the node
+        OUTPUT: a CPT where parent configurations missing from rows are all-zeros rows
+        """
+        cpt = cls()
+        cpt.Allocate(shape)
+        for key, row in rows.items():
+            cpt[key] = row
+        return cpt
+
+
+    @classmethod
+    def FromCounts(cls, counts, alpha = 0.):
+        """
+        Build a dense CPT from a table of counts.
+
+        INPUT:  counts - array of counts of shape (parent levels..., levels)
+                alpha - Dirichlet/Laplace pseudo-count added to every entry. With alpha=0 unseen parent configurations are all-zeros rows
+        OUTPUT: a CPT with each row normalized to sum to one
+        """
+        cpt = cls(np.zeros(np.shape(counts)))
+        cpt.counts = np.array(counts, dtype=float, order='C') ### Update adds to a flat view of the counts
+        cpt.alpha = alpha
+        cpt.Normalize()
+        return cpt
+
+
+    @staticmethod
+    def Counts(data, shape):
+        """
+        Count the parent/node configurations of a set of records in one pass.
+
+        INPUT:  data - integer array with one row per record and one column per CPT axis, (parents..., node)
+                shape - tuple of the parent levels followed by the levels of the node
+        OUTPUT: array of counts of the given shape. Records with a level outside the shape are ignored
+        """
+        shape = tuple(int(s) for s in shape)
+        idx = CPT.Index(data, shape)
+        return np.bincount(idx, minlength=int(np.prod(shape))).reshape(shape).astype(float)
+
+
+    @staticmethod
+    def Index(data, shape):
+        """
+        Flat index into a table of the given shape of each record. Records with a level outside the shape are dropped.
+        """
+        shape = tuple(int(s) for s in shape)
+        data = np.asarray(data, dtype=int).reshape(-1, len(shape))
+        valid = np.all((data >= 0) & (data < np.array(shape, dtype=int)), axis=1)
+        return np.ravel_multi_index(tuple(data[valid].T), shape)
+
+
+    @staticmethod
+    def Pad(counts, shape):
+        """
+        Grow a table of counts with zeros to a larger shape, e.g. when more levels are found while streaming data.
+
+        INPUT:  counts - array of counts, None for an empty table
+                shape - the new shape, no smaller than counts.shape along any axis
+        OUTPUT: array of counts of the given shape
+        """
+        shape = tuple(int(s) for s in shape)
+        if counts is None: return np.zeros(shape)
+        if counts.shape == shape: return counts
+        return np.pad(counts, [(0, s-c) for c, s in zip(counts.shape, shape)], 'constant')
+
+
+    def Normalize(self, rows = None):
+        """
+        Recompute rows of the table from the counts.
+
+        INPUT:  rows - flat indices of the parent configurations to renormalize, None for all of them
+        """
+        levels = self.table.shape[-1]
+        if rows is None: rows = slice(None)
+        counts = self.counts.reshape(-1, levels)[rows]*self.scale + self.alpha
+        total = counts.sum(axis=-1)[...,None]
+        self.table.reshape(-1, levels)[rows] = np.divide(counts, total, out=np.zeros_like(counts), where=total>0)
+        self.version = next(_versions)
+
+
+    def Update(self, data, decay = 1.):
+        """
+        Add the counts of a batch of records and renormalize the affected rows. Cost is linear in the size of the batch.
+
+        INPUT:  data - integer array with one row per record and one column per CPT axis, (parents..., node)
+                decay - exponential forgetting factor applied to the existing counts before the batch is added
+        """
+        self.version = next(_versions)
+        if decay != 1.:
+            self.scale *= decay
+            if self.scale < 1e-100:
+                self.counts *= self.scale
+                self.scale = 1.
+        
+        idx = self.Index(data, self.table.shape)
+        np.add.at(self.counts.reshape(-1), idx, 1./self.scale)
+        
+        ### forgetting changes the weight of the counts relative to the pseudo-counts in every row
+        if decay != 1. and self.alpha > 0:
+            self.Normalize()
+        else:
+            self.Normalize(np.unique(idx // self.table.shape[-1]))
+
+
+    def Allocate(self, shape):
+        """
+        Allocate an all-zeros table of the given shape, (parent levels..., levels)
+        """
+        self.table = np.zeros(tuple(shape))
+        self.version = next(_versions)
+
+
+    def Contract(self, msgs, child = None, keep = (-1,)):
+        """
+        Contract the table with messages living on its axes. Messages may carry leading batch axes which are kept in the output.
+
+        INPUT:  msgs - list with one message per parent, None if the parent's axis is summed with unit weight
+                child - message over the levels of the node, None for unit weight
+                keep - axes of the table kept in the output, parent positions or -1 for the levels of the node
+        OUTPUT: the contracted array of shape (batch..., kept axes...)
+        """
+        n = self.table.ndim
+        operands = [self.table, list(range(n))]
+        for axis, m in enumerate(msgs):
+            if m is not None:
+                operands += [np.asarray(m), [Ellipsis, axis]]
+        if child is not None:
+            operands += [np.asarray(child), [Ellipsis, n-1]]
+        return np.einsum(*(operands + [[Ellipsis] + [k % n for k in keep]]))
+
+
+    def MaxContract(self, msgs, child = None, keep = (-1,)):
+        """
+        Max-product counterpart of Contract: the table is multiplied with the messages and the axes not kept are maximized 
+        over rather than summed. The product is formed in full, of shape (batch..., table shape).
+        """
+        n = self.table.ndim
+        product = self.table
+        for axis, m in list(enumerate(msgs)) + [(n-1, child)]:
+            if m is None: continue
+            m = np.asarray(m)
+            product = product * m.reshape(m.shape[:-1] + (1,)*axis + (m.shape[-1],) + (1,)*(n-1-axis))
+        
+        keep = [k % n for k in keep]
+        batch = product.ndim - n
+        dropped = tuple(batch + a for a in range(n) if a not in keep)
+        if dropped: product = product.max(axis=dropped)
+        ### the kept axes are left in table order
+        kept = sorted(keep)
+        return product.transpose(list(range(batch)) + [batch + kept.index(k) for k in keep])
+
+
+    def keys(self):
+        if self.table is None: return []
+        return list(np.ndindex(*self.table.shape[:-1]))
+
+    def values(self):
+        return [self.table[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self.table[k]) for k in self.keys()]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __len__(self):
+        if self.table is None: return 0
+        return int(np.prod(self.table.shape[:-1]))
+
+    def __contains__(self, key):
+        key = tuple(key)
+        return self.table is not None and len(key) == self.table.ndim-1 and all(0 <= k < s for k, s in zip(key, self.table.shape))
+
+    def __getitem__(self, key):
+        if key not in self: raise KeyError(key)
+        return self.table[tuple(key)]
+
+    def __setitem__(self, key, value):
+        if key not in self: raise KeyError(key)
+        self.table[tuple(key)] = value
+        self.version = next(_versions)
+
+
+class SparseCPT(CPT):
+    """
+    Sparse conditional probability table of a node with parents. Only the observed parent configurations get a row, every
+    other configuration shares a default row: uniform with smoothing, all zeros otherwise. Rows are kept sorted by the flat
+    index of their parent configuration, so memory and contractions scale with the number of observed configurations
+    rather than with the product of the parent levels.
+
+    The dense table is built on demand by the table attribute, for the algorithms without a sparse contraction (junction
+    tree, sampling, max-product, binary export).
+    """
+    def __init__(self, shape):
+        self.shape = tuple(int(s) for s in shape)   ### parent levels followed by the levels of the node
+        self.observed = np.zeros(0, dtype=np.int64) ### flat index of each observed parent configuration, sorted
+        self.rows = np.zeros((0, self.shape[-1]))   ### probability of each level of the node, one row per observed configuration
+        self.default = np.zeros(self.shape[-1])     ### row of the configurations that were not observed
+        self.counts = None ### raw counts, in units of scale, one row per observed configuration
+        self.scale = 1.
+        self.alpha = 0.
+        self.version = next(_versions)
+        self.__Configs()
+
+
+    def __Configs(self):
+        """
+        Parent levels of each observed configuration, one row per configuration and one column per parent
+        """
+        self.configs = np.array(np.unravel_index(self.observed, self.shape[:-1]), dtype=int).T.reshape(-1, len(self.shape)-1)
+
+
+    @classmethod
+    def FromData(cls, data, shape, alpha = 0., weights = None):
+        """
+        Build a sparse CPT from a set of records.
+
+        INPUT:  data - integer array with one row per record and one column per CPT axis, (parents..., node)
+                shape - tuple of the parent levels followed by the levels of the node
+                alpha - Dirichlet/Laplace pseudo-count added to every entry
+                weights - number of times each record was seen, None for once
+        OUTPUT: a SparseCPT with a row per parent configuration found in data
+        """
+        cpt = cls(shape)
+        cpt.counts = np.zeros((0, cpt.shape[-1]))
+        cpt.alpha = alpha
+        cpt.Update(data, weights=weights)
+        return cpt
+
+
+    def Normalize(self, rows = None):
+        levels = self.shape[-1]
+        if rows is None: rows = slice(None)
+        counts = self.counts[rows]*self.scale + self.alpha
+        total = counts.sum(axis=-1)[...,None]
+        self.rows[rows] = np.divide(counts, total, out=np.zeros_like(counts), where=total>0)
+        self.default = np.ones(levels)/levels if self.alpha > 0 else np.zeros(levels)
+        self.version = next(_versions)
+
+
+    def Update(self, data, decay = 1., weights = None):
+        """
+        Add the counts of a batch of records and renormalize the affected rows, adding rows for new parent configurations.
+        weights gives the number of times each record was seen, e.g. for deduplicated records.
+        """
+        self.version = next(_versions)
+        if decay != 1.:
+            self.scale *= decay
+            if self.scale < 1e-100:
+                self.counts *= self.scale
+                self.scale = 1.
+
+        levels = self.shape[-1]
+        if weights is not None:
+            ### Index drops the records outside the shape, drop their weights alike
+            data = np.asarray(data, dtype=int).reshape(-1, len(self.shape))
+            valid = np.all((data >= 0) & (data < np.array(self.shape)), axis=1)
+            data, weights = data[valid], np.asarray(weights, dtype=float)[valid]
+        idx = self.Index(data, self.shape)
+        keys = np.union1d(self.observed, idx // levels)
+        grown = len(keys) > len(self.observed)
+        if grown:
+            counts = np.zeros((len(keys), levels))
+            counts[np.searchsorted(keys, self.observed)] = self.counts
+            self.observed, self.counts, self.rows = keys, counts, np.zeros((len(keys), levels))
+            self.__Configs()
+
+        rows = np.searchsorted(self.observed, idx // levels)
+        np.add.at(self.counts, (rows, idx % levels), (1. if weights is None else weights)/self.scale)
+
+        if grown or (decay != 1. and self.alpha > 0):
+            self.Normalize()
+        else:
+            self.Normalize(np.unique(rows))
+
+
+    @property
+    def table(self):
+        table = np.empty(self.shape)
+        table[...] = self.default
+        table.reshape(-1, self.shape[-1])[self.observed] = self.rows
+        return table
+
+
+    def Contract(self, msgs, child = None, keep = (-1,)):
+        """
+        Contract the table with messages living on its axes, see CPT.Contract. The default row factorizes over the axes,
+        the observed rows add their difference to the default row one configuration at a time.
+        """
+        n = len(self.shape)
+        keep = [k % n for k in keep]
+        msgs = [None if m is None else np.asarray(m) for m in msgs]
+        child = None if child is None else np.asarray(child)
+
+        ### default row: every axis is contracted on its own
+        scale = 1.
+        operands = []
+        for axis, m in enumerate(msgs):
+            m = np.ones(self.shape[axis]) if m is None else m
+            if axis in keep: operands += [m, [Ellipsis, axis]]
+            else: scale = scale * m.sum(axis=-1)
+        d = self.default if child is None else self.default * child
+        if n-1 in keep: operands += [d, [Ellipsis, n-1]]
+        else: scale = scale * d.sum(axis=-1)
+        dense = np.einsum(*(operands + [np.asarray(scale), [Ellipsis], [Ellipsis] + keep]))
+
+        ### observed rows: weight of each configuration, then scatter onto the kept parent axes
+        weights = np.ones(len(self.observed))
+        for axis, m in enumerate(msgs):
+            if m is not None: weights = weights * np.take(m, self.configs[:, axis], axis=-1)
+        delta = self.rows - self.default
+        if n-1 in keep:
+            terms = weights[..., None] * delta
+            if child is not None: terms = terms * child[..., None, :]
+        else:
+            terms = weights * (delta.sum(axis=-1) if child is None else np.dot(child, delta.T))
+
+        kept = [a for a in keep if a != n-1]
+        sizes = [self.shape[a] for a in kept]
+        onehot = np.zeros((len(self.observed), int(np.prod(sizes))))
+        onehot[np.arange(len(self.observed)), np.ravel_multi_index(tuple(self.configs[:, kept].T), sizes) if kept else 0] = 1.
+        if n-1 in keep:
+            sparse = np.swapaxes(np.matmul(np.swapaxes(terms, -1, -2), onehot), -1, -2)
+            sparse = np.moveaxis(sparse.reshape(sparse.shape[:-2] + tuple(sizes) + (self.shape[-1],)), -1, keep.index(n-1) - len(keep))
+        else:
+            sparse = np.dot(terms, onehot)
+            sparse = sparse.reshape(sparse.shape[:-1] + tuple(sizes))
+        return dense + sparse
+
+
+    def keys(self):
+        return list(np.ndindex(*self.shape[:-1]))
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __len__(self):
+        return int(np.prod(self.shape[:-1]))
+
+    def __contains__(self, key):
+        key = tuple(key)
+        return len(key) == len(self.shape)-1 and all(0 <= k < s for k, s in zip(key, self.shape))
+
+    def __Row(self, key):
+        """
+        Position of the row of a parent configuration among the observed rows, or where it would be inserted
+        """
+        k = np.ravel_multi_index(tuple(key), self.shape[:-1])
+        r = np.searchsorted(self.observed, k)
+        return k, r, r < len(self.observed) and self.observed[r] == k
+
+    def __getitem__(self, key):
+        if key not in self: raise KeyError(key)
+        k, r, found = self.__Row(key)
+        return self.rows[r] if found else self.default
+
+    def __setitem__(self, key, value):
+        if key not in self: raise KeyError(key)
+        k, r, found = self.__Row(key)
+        if not found:
+            self.observed = np.insert(self.observed, r, k)
+            self.rows = np.insert(self.rows, r, self.default, axis=0)
+            if self.counts is not None: self.counts = np.insert(self.counts, r, 0., axis=0)
+            self.__Configs()
+        self.rows[r] = value
+        self.version = next(_versions)
@@ -0,0 +1,85 @@
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+__all__ = ['BeliefCache']
+
+class BeliefCache(object):
+    """
+    Bounded least recently used cache of calibrated beliefs. Entries are keyed by the evidence set they were calibrated for
+    and the version of the network, and hold a list of arrays (node beliefs, optionally messages). When the arrays stored
+    exceed max_bytes the least recently used entries are evicted.
+
+    The object keeps count of its hits, misses and evictions.
+    """
+    def __init__(self, max_bytes = 64*2**20, messages = False):
+        self.max_bytes = max_bytes ### memory cap of the arrays stored
+        self.messages = messages   ### whether entries also hold the messages
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+
+
+    @staticmethod
+    def Key(version, evidence):
+        """
+        Canonical key of an evidence set.
+
+        INPUT:  version - version counter of the structure and CPTs of the network
+                evidence - dictionary. key=node name, value=probability distribution
+        OUTPUT: hashable key, independent of the order of the dictionary
+        """
+        digest = hashlib.sha1()
+        for name in sorted(evidence):
+            digest.update(repr(name).encode('utf-8'))
+            digest.update(np.ascontiguousarray(evidence[name], dtype=float).tobytes())
+        return (version, digest.hexdigest())
+
+
+    def Get(self, key):
+        """
+        Stored arrays of an entry, None on a miss. A hit makes the entry the most recently used.
+        """
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+
+    def Put(self, key, arrays):
+        """
+        Store copies of a list of arrays, evicting the least recently used entries to stay under max_bytes.
+        """
+        if key in self.entries:
+            self.nbytes -= sum(a.nbytes for a in self.entries.pop(key))
+        arrays = [np.array(a) for a in arrays]
+        size = sum(a.nbytes for a in arrays)
+        if size > self.max_bytes: return
+
+        while self.nbytes + size > self.max_bytes:
+            old_key, old = self.entries.popitem(last=False)
+            self.nbytes -= sum(a.nbytes for a in old)
+            self.evictions += 1
+        self.entries[key] = arrays
+        self.nbytes += size
+
+
+    def Clear(self):
+        """
+        Drop every entry, e.g. once the network changes.
+        """
+        self.entries.clear()
+        self.nbytes = 0
+
+
+    def Stats(self):
+        """
+        Dictionary of the hits, misses, evictions, number of entries and bytes stored.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'nbytes': self.nbytes}
@@ -0,0 +1,132 @@
+import multiprocessing
+import numpy as np
+
+from .CPT import *
+
+__all__ = ['CountCache']
+
+_shared = {} ### state inherited by forked worker processes, see CountCache.Prefetch
+
+def _CountWorker(key):
+    """
+    Count the configurations of a set of columns in a worker process.
+    """
+    return _shared['cache'].Count(key)
+
+
+class CountCache(object):
+    """
+    Count tables of sets of columns of a data set, used to fit the CPTs of a network. The data is encoded once into an
+    integer matrix of the smallest integer type holding it. Tables are cached by the set of columns they count, and the
+    table of a set of columns contained in a cached set is found by summing the cached table over the other columns
+    when that is cheaper than counting the records again, e.g. the priors of nodes that are parents in larger families.
+    """
+    def __init__(self, columns, levels):
+        """
+        INPUT:  columns - list of arrays of integer levels, one per node, e.g. the columns of a data frame. NaN is a missing value
+                levels - number of levels of each column
+        """
+        ### missing or infinite values are stored as -1, so that the records are skipped by the families of their column
+        columns = [np.asarray(c) for c in columns]
+        lo, hi = -1, 0
+        for c in columns:
+            if c.dtype.kind == 'f': c = c[np.isfinite(c)]
+            if len(c): lo, hi = min(lo, np.min(c)), max(hi, np.max(c))
+        dtype = np.int64
+        for t in (np.int8, np.int16, np.int32):
+            if lo >= np.iinfo(t).min and hi <= np.iinfo(t).max:
+                dtype = t
+                break
+        ### filled a column at a time, so the records are never held as a full matrix of 64 bits integers. Column major, so
+        ### that the columns of a family are read contiguously
+        self.codes = np.empty((len(columns[0]) if columns else 0, len(columns)), dtype=dtype, order='F') ### encoded records, one column per node
+        for i, c in enumerate(columns):
+            self.codes[:, i] = np.where(np.isfinite(c), c, -1) if c.dtype.kind == 'f' else c
+        self.levels = [int(l) for l in levels]
+        self.tables = {} ### count tables. key=sorted tuple of columns, value=table with one axis per column of the key
+        self.index = {} ### cached keys containing each column. key=column, value=list of keys
+
+
+    def Count(self, key):
+        """
+        Count the configurations of a sorted tuple of columns over the records, as CPT.Counts does. Records with a level
+        outside the levels of a column are ignored.
+        """
+        shape = [self.levels[c] for c in key]
+        idx = np.zeros(len(self.codes), dtype=np.int64)
+        valid = np.ones(len(self.codes), dtype=bool)
+        for c, l in zip(key, shape):
+            col = self.codes[:, c]
+            valid &= (col >= 0) & (col < l)
+            idx *= l
+            idx += col
+        return np.bincount(idx[valid], minlength=int(np.prod(shape))).reshape(shape).astype(float)
+
+
+    def __Size(self, key):
+        return int(np.prod([self.levels[c] for c in key]))
+
+
+    def __Superset(self, key, index):
+        """
+        Smallest key containing key whose table is smaller than the number of records, None if there is none.
+
+        INPUT:  index - dictionary. key=column, value=list of the candidate keys containing the column
+        """
+        if not key: return None
+        cols = set(key)
+        found = [ k for k in index.get(min(key, key=lambda c: len(index.get(c, ()))), ())
+                  if k != key and cols <= set(k) and self.__Size(k) <= len(self.codes) ]
+        return min(found, key=self.__Size) if found else None
+
+
+    def __Add(self, key, index):
+        for c in key:
+            index.setdefault(c, []).append(key)
+
+
+    def Prefetch(self, families, workers = None):
+        """
+        Count the tables of a list of families at once. Families contained in a larger family are left to be derived from
+        its table, the other tables are counted on a pool of workers processes if workers is given.
+
+        INPUT:  families - list of lists of columns
+                workers - number of processes, None to count in the calling process
+        """
+        keys = sorted( set( tuple(sorted(set(f))) for f in families ), key=lambda k: (-len(k), -self.__Size(k)) )
+        planned = []
+        index = dict( (c, list(cached)) for c, cached in self.index.items() )
+        for key in keys:
+            if key in self.tables or self.__Superset(key, index) is not None: continue
+            planned.append(key)
+            self.__Add(key, index)
+
+        if workers is not None and workers > 1 and len(planned) > 1:
+            _shared['cache'] = self
+            pool = multiprocessing.Pool(workers)
+            try:
+                tables = pool.map(_CountWorker, planned)
+            finally:
+                pool.close()
+                pool.join()
+                _shared.clear()
+        else:
+            tables = [ self.Count(key) for key in planned ]
+        self.tables.update(zip(planned, tables))
+        for key in planned:
+            self.__Add(key, self.index)
+
+
+    def Counts(self, columns):
+        """
+        Count table of a list of columns, with one axis per column in the given order.
+        """
+        key = tuple(sorted(set(columns)))
+        if key not in self.tables:
+            superset = self.__Superset(key, self.index)
+            if superset is None:
+                self.tables[key] = self.Count(key)
+            else:
+                self.tables[key] = self.tables[superset].sum(axis=tuple(i for i, c in enumerate(superset) if c not in key))
+            self.__Add(key, self.index)
+        return np.transpose(self.tables[key], [key.index(c) for c in columns])
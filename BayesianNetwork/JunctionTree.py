@@ -0,0 +1,212 @@
+import heapq
+from collections import deque
+import numpy as np
+
+__all__ = ['JunctionTree']
+
+def _Contract(factors, out_vars):
+    """
+    Multiply a set of factors and sum out the variables not in out_vars.
+
+    INPUT:  factors - list of (array, variables) pairs, one array axis per variable
+            out_vars - variables kept in the output, in order
+    OUTPUT: array with one axis per variable of out_vars
+    """
+    labels = {}
+    operands = []
+    for table, variables in factors:
+        operands += [table, [labels.setdefault(v, len(labels)) for v in variables]]
+    return np.einsum(*(operands + [[labels.setdefault(v, len(labels)) for v in out_vars]]))
+
+
+class JunctionTree(object):
+    """
+    Junction tree of a Bayes net used for exact inference. The moral graph of the network (built from Node.parents) is
+    triangulated with a greedy elimination ordering, the maximal elimination cliques are joined into a tree by a maximum
+    spanning tree on separator sizes, and every CPT is multiplied into a clique containing its family.
+
+    The compiled tree only depends on the structure and CPTs of the network. Evidence is multiplied into copies of the
+    potentials at calibration time, so the same tree answers queries for any number of evidence sets. As in belief
+    propagation, nodes without a CPT get a uniform prior.
+    """
+    def __init__(self, graph, heuristic = 'min-fill'):
+        """
+        INPUT:  graph - a BayesNet with its interactions loaded
+                heuristic - elimination ordering heuristic, 'min-fill' or 'min-degree'
+        """
+        self.heuristic = heuristic
+        self.names = sorted(graph.Nodes)
+        self.index = dict( (k, i) for i, k in enumerate(self.names) )
+        nodes = [graph.Nodes[k] for k in self.names]
+        ids = dict( (n, i) for i, n in enumerate(nodes) )
+        self.levels = [n.levels for n in nodes]
+
+        ### moral graph: connect each node to its parents and marry the parents
+        adj = [set() for n in nodes]
+        families = []
+        for n in nodes:
+            family = [ids[p] for p in n.parents] + [ids[n]]
+            families.append(family)
+            for u in family:
+                adj[u].update(v for v in family if v != u)
+
+        self.cliques = self.__Triangulate(adj, heuristic)
+        self.__BuildTree()
+
+        ### each variable is attached to the smallest clique containing it, for evidence and marginals
+        self.home = [min(self.members[v], key=lambda c: len(self.cliques[c])) for v in range(len(nodes))]
+
+        self.potentials = [np.ones([self.levels[v] for v in clique]) for clique in self.cliques]
+        for n, family in zip(nodes, families):
+            if len(n.cpt) == 0: continue
+            fam = set(family)
+            c = min((c for c in self.members[family[-1]] if fam <= set(self.cliques[c])), key=lambda c: len(self.cliques[c]))
+            self.potentials[c] = _Contract([(self.potentials[c], self.cliques[c]), (n.cpt.table, family)], self.cliques[c])
+
+        self.beliefs = None
+
+
+    def __Triangulate(self, adj, heuristic):
+        """
+        Greedy elimination of the moral graph. The next variable eliminated minimizes the number of fill-in edges
+        (min-fill) or its number of neighbours (min-degree), ties broken by the size of the clique it creates.
+
+        OUTPUT: list of the maximal elimination cliques as sorted tuples of variables
+        """
+        adj = [set(a) for a in adj]
+
+        def cost(v):
+            if heuristic == 'min-degree':
+                first = len(adj[v])
+            else:
+                nb = list(adj[v])
+                first = sum(1 for a in range(len(nb)) for b in range(a+1, len(nb)) if nb[b] not in adj[nb[a]])
+            return (first, np.prod([self.levels[u] for u in adj[v]]) * self.levels[v], v)
+
+        scores = [cost(v) for v in range(len(adj))]
+        heap = list(scores)
+        heapq.heapify(heap)
+        eliminated = [False]*len(adj)
+
+        cliques = []
+        containing = [[] for v in adj] ### maximal cliques kept so far containing each variable
+        while heap:
+            score = heapq.heappop(heap)
+            v = score[-1]
+            if eliminated[v] or score != scores[v]: continue
+
+            nb = adj[v]
+            clique = tuple(sorted(nb | set([v])))
+            ### an elimination clique can only be contained in a clique created earlier
+            candidates = min([containing[u] for u in clique], key=len)
+            if not any(set(clique) <= set(cliques[c]) for c in candidates):
+                for u in clique: containing[u].append(len(cliques))
+                cliques.append(clique)
+
+            for u in nb:
+                adj[u].discard(v)
+                adj[u].update(w for w in nb if w != u)
+            eliminated[v] = True
+
+            affected = set(nb)
+            if heuristic != 'min-degree':
+                for u in nb: affected.update(adj[u])
+            for u in affected:
+                if not eliminated[u]:
+                    scores[u] = cost(u)
+                    heapq.heappush(heap, scores[u])
+        return cliques
+
+
+    def __BuildTree(self):
+        """
+        Join the cliques with a maximum spanning tree on the separator sizes (Kruskal), giving a forest if the network is
+        disconnected. Sets the neighbours of each clique and the collect order of each tree.
+        """
+        pairs = set()
+        self.members = dict( (v, []) for v in range(len(self.levels)) ) ### cliques containing each variable
+        for c, clique in enumerate(self.cliques):
+            for v in clique: self.members[v].append(c)
+        for cs in self.members.values():
+            pairs.update((a, b) for i, a in enumerate(cs) for b in cs[i+1:])
+
+        root = list(range(len(self.cliques)))
+        def find(c):
+            while root[c] != c:
+                root[c] = root[root[c]]
+                c = root[c]
+            return c
+
+        self.neighbours = [[] for c in self.cliques]
+        for a, b in sorted(pairs, key=lambda p: -len(set(self.cliques[p[0]]) & set(self.cliques[p[1]]))):
+            ra, rb = find(a), find(b)
+            if ra == rb: continue
+            root[ra] = rb
+            self.neighbours[a].append(b)
+            self.neighbours[b].append(a)
+
+        ### breadth first order from the root of each tree; parents come before children
+        self.order = []
+        self.parent = [None]*len(self.cliques)
+        seen = [False]*len(self.cliques)
+        for r in range(len(self.cliques)):
+            if seen[r]: continue
+            seen[r] = True
+            queue = deque([r])
+            while queue:
+                c = queue.popleft()
+                self.order.append(c)
+                for d in self.neighbours[c]:
+                    if not seen[d]:
+                        seen[d] = True
+                        self.parent[d] = c
+                        queue.append(d)
+
+
+    def __Separator(self, a, b):
+        return [v for v in self.cliques[a] if v in self.cliques[b]]
+
+
+    def __Message(self, potentials, msgs, a, b):
+        """
+        Shafer-Shenoy message from clique a to clique b, normalized to sum to one.
+        """
+        factors = [(potentials[a], self.cliques[a])] + [(msgs[(c, a)], self.__Separator(c, a)) for c in self.neighbours[a] if c != b]
+        msg = _Contract(factors, self.__Separator(a, b))
+        return msg/np.sum(msg)
+
+
+    def Calibrate(self, evidence = {}):
+        """
+        Calibrate the tree with a set of evidence using one collect and one distribute pass.
+
+        INPUT:  evidence - dictionary. key=node name, value=likelihood of each level of the node
+        OUTPUT: calibrated clique beliefs, read with Marginal
+        """
+        potentials = list(self.potentials)
+        for name, ev in evidence.items():
+            v = self.index[name]
+            c = self.home[v]
+            potentials[c] = _Contract([(potentials[c], self.cliques[c]), (np.asarray(ev, dtype=float), [v])], self.cliques[c])
+
+        msgs = {}
+        for c in reversed(self.order):
+            if self.parent[c] is not None:
+                msgs[(c, self.parent[c])] = self.__Message(potentials, msgs, c, self.parent[c])
+        for c in self.order:
+            if self.parent[c] is not None:
+                msgs[(self.parent[c], c)] = self.__Message(potentials, msgs, self.parent[c], c)
+
+        self.beliefs = [ _Contract([(potentials[c], self.cliques[c])] + [(msgs[(d, c)], self.__Separator(d, c)) for d in self.neighbours[c]], self.cliques[c])
+                         for c in range(len(self.cliques)) ]
+        return self.beliefs
+
+
+    def Marginal(self, name):
+        """
+        Marginal probability of each level of a node, from the calibrated belief of its smallest clique.
+        """
+        v = self.index[name]
+        c = self.home[v]
+        marginal = _Contract([(self.beliefs[c], self.cliques[c])], [v])
+        return marginal/np.sum(marginal)
@@ -0,0 +1,60 @@
+import numpy as np
+
+__all__ = ['Messages']
+
+class Messages(object):
+    """
+    Set of messages living on the edges of a compiled Bayes net. The messages are stored back to back in one flat buffer,
+    the message on edge number e being buf[..., offsets[e]:offsets[e+1]]. Leading axes of the buffer, if any, are batch axes.
+
+    The object behaves like the dictionary keyed by (Node, Node) edges it replaces: msgs[(u,v)] is a view into the buffer.
+    """
+    def __init__(self, buf, offsets, edge_ids):
+        self.buf = buf           ### flat message buffer
+        self.offsets = offsets   ### start of the message of each edge, followed by the total buffer size
+        self.edge_ids = edge_ids ### dictionary. key=(Node, Node) edge, value=edge number
+
+
+    def Edge(self, e):
+        """
+        Message living on edge number e
+        """
+        return self.buf[..., self.offsets[e]:self.offsets[e+1]]
+
+
+    def copy(self):
+        ### copies of the messages, the views of items() change as the buffers are updated
+        return dict((k, v.copy()) for k, v in self.items())
+
+    def keys(self):
+        return sorted(self.edge_ids, key=self.edge_ids.get)
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __len__(self):
+        return len(self.edge_ids)
+
+    def __contains__(self, edge):
+        return edge in self.edge_ids
+
+    def __getitem__(self, edge):
+        return self.Edge(self.edge_ids[edge])
+
+    def __setitem__(self, edge, msg):
+        self.Edge(self.edge_ids[edge])[...] = msg
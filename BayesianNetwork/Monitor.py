@@ -0,0 +1,89 @@
+import numpy as np
+
+__all__ = ['BPResult', 'Observer']
+
+class BPResult(object):
+    """
+    Outcome of a call to BayesNet.BeliefPropagation. The object has the attributes:
+        1) converged, whether the messages converged and the beliefs were computed. The object is true if they did
+        2) schedule, the message schedule used, 'cache' if the beliefs were restored from the cache
+        3) steps, the number of iterations (flooding), message updates (residual) or passes (two-pass)
+        4) seconds, the wall time of the call
+        5) residuals, the largest change of a message at each step, as computed by the convergence test
+
+    With profiling on, it also has, by edge number (see BayesNet.Compile) and node number (sorted node names):
+        6) edge_updates, the number of new messages computed on each edge, of shape (2, edges) for the down and up messages
+        7) edge_seconds, the time spent computing them, of the same shape
+        8) node_seconds, the time spent contracting the CPT of each node with its messages
+    Messages computed in worker processes (the 'process' executor) are not profiled.
+    """
+    def __init__(self, names, n_edges, profile = False):
+        self.names = names ### node names by node number
+        self.converged = False
+        self.schedule = None
+        self.steps = 0
+        self.seconds = 0.
+        self.residuals = []
+        self.profile = profile
+        self.edge_updates = np.zeros((2, n_edges), dtype=int) if profile else None
+        self.edge_seconds = np.zeros((2, n_edges)) if profile else None
+        self.node_seconds = np.zeros(len(names)) if profile else None
+
+
+    def __nonzero__(self):
+        return self.converged
+
+    __bool__ = __nonzero__
+
+
+    def SlowestNodes(self, k = 10):
+        """
+        The k nodes with the largest CPT contraction time, as a list of (node name, seconds)
+        """
+        if not self.profile: return []
+        return [ (self.names[n], self.node_seconds[n]) for n in np.argsort(-self.node_seconds, kind='mergesort')[:k] ]
+
+
+    def SlowestEdges(self, k = 10):
+        """
+        The k edges with the largest message update time (down and up), as a list of (edge number, seconds)
+        """
+        if not self.profile: return []
+        seconds = self.edge_seconds.sum(axis=0)
+        return [ (int(e), seconds[e]) for e in np.argsort(-seconds, kind='mergesort')[:k] ]
+
+
+    def toDict(self):
+        """
+        Dictionary of plain Python types, e.g. for json.dump
+        """
+        out = {'converged': bool(self.converged), 'schedule': self.schedule, 'steps': int(self.steps),
+               'seconds': self.seconds, 'residuals': [float(r) for r in self.residuals]}
+        if self.profile:
+            out.update( edge_updates=self.edge_updates.tolist(), edge_seconds=self.edge_seconds.tolist(),
+                        node_seconds=dict(zip(self.names, self.node_seconds.tolist())) )
+        return out
+
+
+class Observer(object):
+    """
+    Callbacks of BayesNet.BeliefPropagation. Subclass and override the methods of interest, the defaults do nothing.
+    """
+    def OnStart(self, graph, result):
+        """
+        Called once the schedule is chosen, before any message is updated
+        """
+        pass
+
+    def OnStep(self, result, step, residual):
+        """
+        Called after each flooding iteration or residual message update with the residual of the step, also appended
+        to result.residuals
+        """
+        pass
+
+    def OnFinish(self, result):
+        """
+        Called with the final result
+        """
+        pass
@@ -3,6 +3,8 @@ from itertools import product
 import numpy as np
 import glob,re,json
 
+from .CPT import *
+
 __all__ = ['Node']
 
 class Node():
@@ -21,7 +23,7 @@ class Node():
     def __init__(self):
         self.levels = 0   ### number of levels/states each node can take
         self.order = []   ### order which indices are listed in the CPT/interaction
-        self.cpt = { }    ### interactions/CPT describing how the dependent variable respondes to the independent variables
+        self.cpt = CPT()  ### interactions/CPT describing how the dependent variable respondes to the independent variables
         self.beliefs = [] ### beliefs/probabilities about being in each state
         self.parents = []
         self.children = []
@@ -35,16 +37,26 @@ class Node():
         for i,k in enumerate(self.parents):
             if k==p: return i
     
+    def ParentMsgs(self, down_msgs, excluding=None):
+        """
+        Collects the messages coming from the parents of a node, in the order of the CPT axes.
+
+        INPUT:  down_msgs - set of down messages
+                excluding - if messages from any node instance should be ignored
+        OUTPUT: list of messages, None in place of an ignored parent
+        """
+        return [None if k == excluding else down_msgs[(k,self)] for k in self.parents]
+
     def MergeDown(self, down_msgs, excluding=None):
         """
         Performs a merge of messages coming from the parents of a node.
 
         INPUT:  down_msgs - set of down messages
                 excluding - if messages from any node instance should be ignored
-        OUTPUT: merged messages
+        OUTPUT: merged messages, one row per CPT key (in the order of cpt.keys()) and one column per level
         """
-        return [self.cpt[key]*np.product([down_msgs[(k,self)][key[idx]] for idx,k in enumerate(self.parents) if k != excluding])
-                for key in self.cpt.keys()]
+        merged = self.cpt.Contract(self.ParentMsgs(down_msgs, excluding), keep=range(self.cpt.table.ndim))
+        return merged.reshape(-1, self.levels)
     
     def MergeUp(self, up_msgs, excluding=None):
         """
@@ -55,7 +67,7 @@ class Node():
         OUTPUT: merged messages
         """
         if len(self.evidence)>0: return self.evidence
-        return np.product([ up_msgs[(self,k)] for k in self.children if k != excluding ],axis=0)
+        return np.product([ up_msgs[(self,k)] for k in self.children if k != excluding ] or [np.ones(self.levels)],axis=0)
     
     
     def ComputeBeliefs(self, down_msgs, up_msgs):
@@ -64,11 +76,8 @@ class Node():
         """
         msgs_up = self.MergeUp(up_msgs)
         
-        if len(self.cpt.keys()) >0:
-            marginalized_down_msgs = np.sum( self.MergeDown(down_msgs), axis=0)
+        if len(self.cpt) >0:
+            self.beliefs = self.cpt.Contract(self.ParentMsgs(down_msgs), child=msgs_up)
         else:
-            marginalized_down_msgs = [1.]*self.levels
-        
-        self.beliefs = np.multiply(msgs_up, marginalized_down_msgs)
+            self.beliefs = np.multiply(msgs_up, [1.]*self.levels)
         self.beliefs /= np.sum(self.beliefs)
-
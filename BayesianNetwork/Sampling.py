@@ -0,0 +1,198 @@
+import time
+import numpy as np
+
+__all__ = ['Sampler']
+
+class Sampler(object):
+    """
+    Approximate inference by sampling, for networks too large for the junction tree and where belief propagation does not
+    converge. Samples are drawn in batches as integer arrays of shape (batch, nodes), one column per node, the nodes being
+    visited in topological order so that every CPT lookup is a single fancy index over the whole batch.
+
+    Two estimators are available:
+        'likelihood' - likelihood weighting. Each node is drawn from its CPT row times its evidence and the sample is
+                       weighted by the sum of that product, which is importance sampling for hard and soft evidence alike.
+        'gibbs'      - Gibbs sampling with one chain per row of the batch, started from a likelihood weighted sample. Each
+                       sweep redraws every node from its distribution given its Markov blanket. The marginals average these
+                       conditional distributions (Rao-Blackwellization).
+
+    Both return the standard error of each marginal probability: the delta method estimate of the self-normalized importance
+    sampler for 'likelihood', the spread of the per chain estimates for 'gibbs'. As in belief propagation, nodes without a CPT
+    get a uniform prior.
+    """
+    def __init__(self, graph):
+        """
+        INPUT:  graph - a BayesNet with its interactions loaded
+        """
+        self.names = sorted(graph.Nodes)
+        nodes = [graph.Nodes[k] for k in self.names]
+        ids = dict( (n, i) for i, n in enumerate(nodes) )
+        self.levels = [n.levels for n in nodes]
+
+        ### a node without a CPT does not depend on its parents
+        self.parents = [[ids[p] for p in n.parents] if len(n.cpt) > 0 else [] for n in nodes]
+        self.tables = [n.cpt.table if len(n.cpt) > 0 else np.ones(n.levels)/n.levels for n in nodes]
+        self.children = [[] for n in nodes] ### (child, axis of the node in the CPT of the child)
+        for c, parents in enumerate(self.parents):
+            for axis, p in enumerate(parents):
+                self.children[p].append((c, axis))
+
+        self.order = []
+        indegree = [len(p) for p in self.parents]
+        queue = [v for v in range(len(nodes)) if indegree[v] == 0]
+        for v in queue:
+            self.order.append(v)
+            for c, axis in self.children[v]:
+                indegree[c] -= 1
+                if indegree[c] == 0: queue.append(c)
+        if len(self.order) < len(nodes):
+            raise ValueError('the network has a directed cycle')
+        self.samples = 0 ### number of samples drawn by the last estimate
+
+
+    def __Rows(self, v, x):
+        """
+        CPT row of node v for the parent levels of each sample, shape (batch, levels)
+        """
+        if not self.parents[v]:
+            return np.broadcast_to(self.tables[v], (len(x), self.levels[v]))
+        return self.tables[v][tuple(x[:, p] for p in self.parents[v])]
+
+
+    @staticmethod
+    def __Draw(weights, rng):
+        """
+        Draw one level per row of a (batch, levels) array of unnormalized probabilities. All-zeros rows give level 0.
+        """
+        cum = np.cumsum(weights, axis=1)
+        u = rng.rand(len(weights)) * cum[:, -1]
+        return np.minimum((cum <= u[:, None]).sum(axis=1), weights.shape[1]-1)
+
+
+    def __Forward(self, size, evidence, rng):
+        """
+        Draw a batch of likelihood weighted samples.
+
+        OUTPUT: samples of shape (size, nodes) and the log weight of each sample
+        """
+        x = np.zeros((size, len(self.levels)), dtype=int)
+        logw = np.zeros(size)
+        with np.errstate(divide='ignore'):
+            for v in self.order:
+                rows = self.__Rows(v, x)
+                if evidence[v] is not None: rows = rows * evidence[v]
+                logw += np.log(rows.sum(axis=1))
+                x[:, v] = self.__Draw(rows, rng)
+        return x, logw
+
+
+    def __Conditional(self, v, x, evidence):
+        """
+        Distribution of node v given its Markov blanket in each sample, shape (batch, levels), rows summing to one or zero.
+        """
+        cond = np.array(self.__Rows(v, x))
+        if evidence[v] is not None: cond *= evidence[v]
+        levels = np.arange(self.levels[v])
+        for c, axis in self.children[v]:
+            index = [x[:, p, None] for p in self.parents[c]] + [x[:, c, None]]
+            index[axis] = levels[None, :]
+            cond *= self.tables[c][tuple(index)]
+            cond /= np.maximum(cond.max(axis=1), 1e-300)[:, None]
+        total = cond.sum(axis=1)[:, None]
+        return np.divide(cond, total, out=np.zeros_like(cond), where=total>0)
+
+
+    @staticmethod
+    def __Done(drawn, samples, start, seconds):
+        return (samples is not None and drawn >= samples) or (seconds is not None and time.time()-start >= seconds)
+
+
+    def LikelihoodWeighting(self, evidence = {}, samples = 100000, seconds = None, batch = 10000, rng = None):
+        """
+        Estimate the marginals by likelihood weighting. Batches are drawn till samples are drawn or seconds have passed,
+        whichever comes first, and at least one batch is drawn.
+
+        INPUT:  evidence - dictionary. key=node name, value=likelihood of each level of the node
+                samples - sample budget, None for no limit
+                seconds - time budget, None for no limit
+                batch - number of samples drawn at a time
+                rng - np.random.RandomState
+        OUTPUT: the marginal probabilities and their standard errors, lists of arrays by node name order, and the effective
+                sample size of the weights
+        """
+        rng = rng or np.random.RandomState()
+        ev = [None]*len(self.levels)
+        for k, e in evidence.items():
+            ev[self.names.index(k)] = np.asarray(e, dtype=float)
+
+        ### weighted counts, scaled by exp(-shift) so that the weights do not underflow
+        shift = -np.inf
+        sum_w = sum_w2 = 0.
+        sums = [np.zeros(l) for l in self.levels]
+        sums2 = [np.zeros(l) for l in self.levels]
+
+        drawn, start = 0, time.time()
+        while drawn == 0 or not self.__Done(drawn, samples, start, seconds):
+            size = batch if samples is None else min(batch, samples-drawn)
+            x, logw = self.__Forward(size, ev, rng)
+            drawn += size
+            if logw.max() == -np.inf: continue
+            if logw.max() > shift:
+                r = np.exp(shift - logw.max())
+                sum_w, sum_w2 = sum_w*r, sum_w2*r*r
+                sums, sums2 = [s*r for s in sums], [s*r*r for s in sums2]
+                shift = logw.max()
+            w = np.exp(logw - shift)
+            sum_w += w.sum()
+            sum_w2 += (w*w).sum()
+            for v, l in enumerate(self.levels):
+                sums[v] += np.bincount(x[:, v], weights=w, minlength=l)
+                sums2[v] += np.bincount(x[:, v], weights=w*w, minlength=l)
+        self.samples = drawn
+
+        if sum_w == 0:
+            nan = [np.nan*np.ones(l) for l in self.levels]
+            return nan, nan, 0.
+        beliefs = [s/sum_w for s in sums]
+        ### sum of w^2 (1[x=k] - p)^2 over the samples, divided by (sum of w)^2
+        stderr = [np.sqrt(np.maximum(s2*(1-2*p) + p*p*sum_w2, 0))/sum_w for p, s2 in zip(beliefs, sums2)]
+        return beliefs, stderr, sum_w**2/sum_w2
+
+
+    def Gibbs(self, evidence = {}, samples = 100000, seconds = None, chains = 100, burn_in = 100, rng = None):
+        """
+        Estimate the marginals by Gibbs sampling. After burn_in sweeps, sweeps are kept till samples (chains times kept
+        sweeps) are drawn or seconds have passed, whichever comes first, and at least one sweep is kept. Chains can get
+        stuck where the CPTs have zero probabilities.
+
+        INPUT:  evidence - dictionary. key=node name, value=likelihood of each level of the node
+                samples - sample budget, None for no limit
+                seconds - time budget, None for no limit
+                chains - number of chains run side by side, at least two for standard errors
+                burn_in - number of sweeps dropped at the start of each chain
+                rng - np.random.RandomState
+        OUTPUT: the marginal probabilities and their standard errors, lists of arrays by node name order
+        """
+        rng = rng or np.random.RandomState()
+        ev = [None]*len(self.levels)
+        for k, e in evidence.items():
+            ev[self.names.index(k)] = np.asarray(e, dtype=float)
+
+        x, logw = self.__Forward(chains, ev, rng)
+        sums = [np.zeros((chains, l)) for l in self.levels]
+
+        sweeps, start = 0, time.time()
+        while sweeps <= burn_in or not self.__Done((sweeps-burn_in)*chains, samples, start, seconds):
+            for v in self.order:
+                cond = self.__Conditional(v, x, ev)
+                stuck = cond.sum(axis=1) == 0
+                x[:, v] = np.where(stuck, x[:, v], self.__Draw(cond, rng))
+                if sweeps >= burn_in: sums[v] += cond
+            sweeps += 1
+        kept = sweeps - burn_in
+        self.samples = kept*chains
+
+        means = [s/kept for s in sums]
+        beliefs = [m.mean(axis=0) for m in means]
+        stderr = [m.std(axis=0, ddof=1)/np.sqrt(chains) if chains > 1 else np.nan*np.ones(m.shape[1]) for m in means]
+        return beliefs, stderr
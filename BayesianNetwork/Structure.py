@@ -0,0 +1,188 @@
+import multiprocessing
+from math import lgamma
+import numpy as np
+
+__all__ = ['HillClimbing']
+
+_lgamma = np.frompyfunc(lgamma, 1, 1)
+
+_shared = {} ### state inherited by forked worker processes, see HillClimbing.__Scores
+
+def _ScoreWorker(families):
+    """
+    Score a list of (node, parents) families in a worker process.
+    """
+    return [ _shared['search'].FamilyScore(v, parents) for v, parents in families ]
+
+
+class HillClimbing(object):
+    """
+    Score based structure learning. Starting from the empty graph, the search applies the edge addition, deletion or
+    reversal that improves the score of the network the most, till no move improves it. The score of a network is the
+    sum of the scores of its families (a node and its parents):
+        'bic'  - log likelihood of the data under the maximum likelihood CPTs, less log(records)/2 per free parameter
+        'bdeu' - log marginal likelihood of the data with a uniform Dirichlet prior of equivalent sample size ess
+
+    Family scores are computed from count tables built with a single bincount over the records and cached. The score
+    change of every move is kept in tables of which only the columns of the nodes whose parents changed are recomputed
+    after a move. Scores can be computed on a pool of forked processes.
+    """
+    def __init__(self, data, levels = None, score = 'bic', ess = 1., max_parents = 3):
+        """
+        INPUT:  data - integer array with one row per record and one column per node
+                levels - number of levels of each node, by default the largest value of its column plus one
+                score - 'bic' or 'bdeu'
+                ess - equivalent sample size of the BDeu prior
+                max_parents - largest number of parents of a node
+        """
+        self.data = np.asarray(data, dtype=int)
+        self.levels = np.asarray(levels if levels is not None else self.data.max(axis=0)+1, dtype=int)
+        self.score = score
+        self.ess = ess
+        self.max_parents = max_parents
+        self.cache = {} ### family scores. key=(node, sorted tuple of parents), value=score
+        self.parents = [ [] for v in self.levels ] ### parents of each node in the learnt graph
+        self.moves = 0 ### number of moves applied by the last search
+        self.workers = None
+
+
+    def FamilyScore(self, v, parents):
+        """
+        Score of node v with a tuple of parents, computed from the counts of the (parents, node) configurations.
+        """
+        r = self.levels[v]
+        q = int(np.prod([self.levels[p] for p in parents]))
+        if parents:
+            config = np.ravel_multi_index(tuple(self.data[:, p] for p in parents), [self.levels[p] for p in parents])
+        else:
+            config = np.zeros(len(self.data), dtype=int)
+        counts = np.bincount(config*r + self.data[:, v])
+        totals = np.bincount(config)
+        counts = counts[counts > 0].astype(float)
+        totals = totals[totals > 0].astype(float)
+
+        if self.score == 'bdeu':
+            a_j, a_jk = self.ess/q, self.ess/(q*r)
+            return float( np.sum(_lgamma(a_jk + counts)) - len(counts)*lgamma(a_jk)
+                          + len(totals)*lgamma(a_j) - np.sum(_lgamma(a_j + totals)) )
+        loglik = np.sum(counts*np.log(counts)) - np.sum(totals*np.log(totals))
+        return float( loglik - 0.5*np.log(len(self.data))*(r-1)*q )
+
+
+    def __Scores(self, families, pool):
+        """
+        Scores of a list of (node, parents) families, from the cache or computed, on the pool if one is given.
+        """
+        missing = list(set( f for f in families if f not in self.cache ))
+        if pool is not None and len(missing) > 1:
+            size = -(-len(missing) // (4*self.workers))
+            chunks = [ missing[i:i+size] for i in xrange(0, len(missing), size) ]
+            for chunk, scores in zip(chunks, pool.map(_ScoreWorker, chunks)):
+                self.cache.update(zip(chunk, scores))
+        else:
+            for v, parents in missing:
+                self.cache[(v, parents)] = self.FamilyScore(v, parents)
+        return [ self.cache[f] for f in families ]
+
+
+    def __Deltas(self, nodes, add, delete, pool):
+        """
+        Recompute the score changes of adding or deleting an edge u -> v into node v, for each v in nodes.
+
+        INPUT:  add, delete - arrays of shape (nodes, nodes), add[u, v] being the score change of adding u -> v
+        """
+        V = len(self.levels)
+        current, moves = [], []
+        for v in nodes:
+            parents = set(self.parents[v])
+            current.append( (v, tuple(sorted(parents))) )
+            for u in xrange(V):
+                if u == v: continue
+                if u in parents:
+                    moves.append( (delete, u, v, (v, tuple(sorted(parents - set([u]))))) )
+                elif len(parents) < self.max_parents:
+                    moves.append( (add, u, v, (v, tuple(sorted(parents | set([u]))))) )
+        scores = self.__Scores(current + [m[-1] for m in moves], pool)
+        base = dict(zip(nodes, scores[:len(current)]))
+
+        for v in nodes:
+            add[:, v] = delete[:, v] = -np.inf
+        for (table, u, v, family), score in zip(moves, scores[len(current):]):
+            table[u, v] = score - base[v]
+
+
+    def __Reaches(self, a, b, skip = None):
+        """
+        Whether there is a directed path from node a to node b, ignoring the edge skip
+        """
+        children = [ [] for v in self.levels ]
+        for v, parents in enumerate(self.parents):
+            for p in parents:
+                if (p, v) != skip: children[p].append(v)
+        seen, stack = set([a]), [a]
+        while stack:
+            for c in children[stack.pop()]:
+                if c == b: return True
+                if c not in seen:
+                    seen.add(c)
+                    stack.append(c)
+        return False
+
+
+    def Search(self, max_moves = 10000, tol = 1e-6, workers = None):
+        """
+        Run the hill climbing search from the current parents, the empty graph by default.
+
+        INPUT:  max_moves - largest number of moves applied
+                tol - smallest score improvement of a move
+                workers - number of processes scoring families, None to score in the calling process
+        OUTPUT: the parents of each node, also kept in self.parents
+        """
+        pool = None
+        self.workers = workers
+        if workers is not None and workers > 1:
+            _shared['search'] = self
+            pool = multiprocessing.Pool(workers)
+        try:
+            self.__Climb(max_moves, tol, pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+                _shared.clear()
+        return self.parents
+
+
+    def __Climb(self, max_moves, tol, pool):
+        V = len(self.levels)
+        add, delete = -np.inf*np.ones((V, V)), -np.inf*np.ones((V, V))
+        self.__Deltas(range(V), add, delete, pool)
+
+        for moves in xrange(max_moves):
+            ### reversing u -> v deletes it and adds v -> u
+            reverse = delete + add.T
+            deltas = np.concatenate([add.ravel(), delete.ravel(), reverse.ravel()])
+            best = None
+            for i in np.argsort(-deltas, kind='mergesort'):
+                if deltas[i] <= tol: break
+                kind, u, v = i // (V*V), (i % (V*V)) // V, i % V
+                if kind == 0 and self.__Reaches(v, u): continue
+                if kind == 2 and self.__Reaches(u, v, skip=(u, v)): continue
+                best = (kind, u, v)
+                break
+            if best is None:
+                self.moves = moves
+                return
+
+            kind, u, v = best
+            if kind == 0:
+                self.parents[v].append(u)
+                self.__Deltas([v], add, delete, pool)
+            elif kind == 1:
+                self.parents[v].remove(u)
+                self.__Deltas([v], add, delete, pool)
+            else:
+                self.parents[v].remove(u)
+                self.parents[u].append(v)
+                self.__Deltas([u, v], add, delete, pool)
+        self.moves = max_moves
@@ -1 +1 @@
-__all__ = [ 'utils', 'BayesNet' ]
+__all__ = [ 'utils', 'BayesNet', 'CPT', 'Messages', 'JunctionTree', 'Cache', 'Sampling', 'Monitor', 'Structure', 'Fitting' ]
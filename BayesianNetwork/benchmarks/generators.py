@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+__all__ = ['Structure', 'SampleData', 'Generate']
+
+KINDS = ['chain', 'tree', 'polytree', 'grid', 'dag']
+
+def Structure(kind, n, fanin = 2, rng = None):
+    """
+    Random network structure. Nodes are named X0, X1, ... and the parents of a node always come before it.
+
+    INPUT:  kind - 'chain', 'tree' (one parent per node), 'polytree' (a tree with random edge directions), 'grid' (a square 
+                   grid, each node depending on the nodes above and to the left of it) or 'dag' (random directed acyclic graph)
+            n - number of nodes, rounded down to a square for a grid
+            fanin - maximum number of parents of a node of a polytree or dag
+            rng - np.random.RandomState
+    OUTPUT: node names and a dictionary. key=dependent node, value=list of nodes which the key is dependent on
+    """
+    rng = rng or np.random.RandomState()
+    parents = [[] for i in xrange(n)]
+    if kind == 'chain':
+        for i in xrange(1, n): parents[i] = [i-1]
+    elif kind == 'tree':
+        for i in xrange(1, n): parents[i] = [rng.randint(i)]
+    elif kind == 'polytree':
+        ### each new node is linked to an earlier one, away from it or towards it while the earlier node has room for a parent
+        for i in xrange(1, n):
+            j = rng.randint(i)
+            if rng.rand() < 0.5 and len(parents[j]) < fanin: parents[j].append(i)
+            else: parents[i] = [j]
+        ### renumber in topological order so that parents come first
+        order, seen = [], [False]*n
+        def visit(i):
+            if seen[i]: return
+            seen[i] = True
+            for p in parents[i]: visit(p)
+            order.append(i)
+        for i in xrange(n): visit(i)
+        rank = dict( (i, r) for r, i in enumerate(order) )
+        parents = [sorted(rank[p] for p in parents[i]) for i in order]
+    elif kind == 'grid':
+        side = int(np.sqrt(n))
+        n = side*side
+        parents = [ [i-side]*(i >= side) + [i-1]*(i % side > 0) for i in xrange(n) ]
+    elif kind == 'dag':
+        for i in xrange(1, n):
+            k = rng.randint(min(i, fanin)+1)
+            parents[i] = sorted(rng.choice(i, k, replace=False).tolist())
+    else:
+        raise ValueError('unknown structure %s' % kind)
+
+    names = ['X%d' % i for i in xrange(n)]
+    return names, dict( (names[i], [names[p] for p in parents[i]]) for i in xrange(n) )
+
+
+def SampleData(names, interactions, levels = 3, records = 10000, concentration = 1., rng = None):
+    """
+    Draw records from random CPTs by ancestral sampling, to fit networks on.
+
+    INPUT:  names - node names in topological order
+            interactions - a dictionary. key=dependent node, value=list of nodes which the key is dependent on
+            levels - number of levels of every node
+            records - number of records
+            concentration - parameter of the symmetric Dirichlet distribution the rows of the CPTs are drawn from
+            rng - np.random.RandomState
+    OUTPUT: a pandas data frame with one integer column per node
+    """
+    rng = rng or np.random.RandomState()
+    data = {}
+    for name in names:
+        parents = interactions.get(name, [])
+        table = rng.dirichlet([concentration]*levels, size=levels**len(parents)).reshape([levels]*len(parents) + [levels])
+        rows = table[tuple(data[p] for p in parents)] if parents else np.tile(table, (records, 1))
+        cum = np.cumsum(rows, axis=1)
+        data[name] = np.minimum((cum <= rng.rand(records)[:, None]).sum(axis=1), levels-1)
+    return pd.DataFrame(data, columns=names)
+
+
+def Generate(kind, n, fanin = 2, levels = 3, records = 10000, seed = None):
+    """
+    Synthetic benchmark instance, see Structure and SampleData.
+
+    OUTPUT: a pandas data frame of records and a dictionary of interactions, to build a BayesNet from
+    """
+    rng = np.random.RandomState(seed)
+    names, interactions = Structure(kind, n, fanin, rng)
+    return SampleData(names, interactions, levels, records, rng=rng), interactions
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+"""
+Time the hot paths of BayesNet on synthetic networks and write a JSON report, e.g.
+
+    python -m BayesianNetwork.benchmarks.run --kinds chain grid --nodes 100 1000 --output report.json
+
+For each structure and size the report gives the best time over the repeats of
+    fit        - CPT fitting with NodesFromCSV and InteractionsFromCSV
+    initialize - InitializeGraphMsgs
+    iteration  - one flooding iteration of BeliefPropagation
+    bp         - BeliefPropagation to convergence with each schedule, and whether it converged
+    beliefs    - GetBeliefs
+"""
+
+import sys, os, time, json, platform, argparse
+from contextlib import contextmanager
+import numpy as np
+
+from ..BayesNet import *
+from .generators import *
+from .generators import KINDS
+
+@contextmanager
+def _Quiet():
+    """
+    Silence the progress messages printed by BayesNet
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def _Time(f, repeat):
+    """
+    Best time of repeat calls of f, and the value of the last call
+    """
+    best = np.inf
+    for r in xrange(repeat):
+        start = time.time()
+        value = f()
+        best = min(best, time.time() - start)
+    return best, value
+
+
+def Benchmark(kind, n, fanin = 2, levels = 3, records = 10000, repeat = 3, MaxIter = 1000, tol = 1e-4, seed = 0):
+    """
+    Time fitting, message initialization, belief propagation and belief computation on one synthetic network.
+
+    INPUT:  kind, n, fanin, levels, records - see generators.Generate
+            repeat - number of times each step is timed, the best time is kept
+            MaxIter, tol - passed to BeliefPropagation
+            seed - seed of the network, data and initial messages
+    OUTPUT: dictionary of the parameters and timings in seconds
+    """
+    dat, interactions = Generate(kind, n, fanin, levels, records, seed)
+    result = {'kind': kind, 'nodes': len(dat.columns), 'edges': sum(len(p) for p in interactions.values()),
+              'fanin': fanin, 'levels': levels, 'records': records}
+
+    with _Quiet():
+        def fit():
+            G = BayesNet()
+            G.NodesFromCSV(dat)
+            G.InteractionsFromCSV(interactions, dat)
+            return G
+        result['fit'], G = _Time(fit, repeat)
+        result['initialize'], _ = _Time(G.InitializeGraphMsgs, repeat)
+        result['polytree'] = G.polytree
+
+        result['iteration'], _ = _Time(lambda: G.BeliefPropagation(MaxIter=1, tol=0., schedule='flooding'), repeat)
+
+        result['bp'] = {}
+        for schedule in ['flooding', 'residual'] + ['two-pass']*G.polytree:
+            best = np.inf
+            for r in xrange(repeat):
+                np.random.seed(seed)
+                G.InitializeGraphMsgs()
+                start = time.time()
+                G.BeliefPropagation(MaxIter, tol, schedule=schedule)
+                best = min(best, time.time() - start)
+            result['bp'][schedule] = {'seconds': best, 'converged': G.calibrated}
+
+        result['beliefs'], _ = _Time(G.GetBeliefs, repeat)
+    return result
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Benchmark BayesNet inference on synthetic networks')
+    parser.add_argument('--kinds', nargs='+', default=KINDS, choices=KINDS)
+    parser.add_argument('--nodes', nargs='+', type=int, default=[100, 1000])
+    parser.add_argument('--fanin', type=int, default=2)
+    parser.add_argument('--levels', type=int, default=3)
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--MaxIter', type=int, default=1000)
+    parser.add_argument('--tol', type=float, default=1e-4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args(argv)
+
+    report = {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': []}
+    for kind in args.kinds:
+        for n in args.nodes:
+            result = Benchmark(kind, n, args.fanin, args.levels, args.records, args.repeat, args.MaxIter, args.tol, args.seed)
+            print '%-8s %6d nodes  fit %.3fs  init %.3fs  iteration %.4fs  beliefs %.4fs  ' % (kind, result['nodes'],
+                  result['fit'], result['initialize'], result['iteration'], result['beliefs']) + \
+                  '  '.join('%s %.3fs%s' % (s, r['seconds'], '' if r['converged'] else ' (not converged)') for s, r in sorted(result['bp'].items()))
+            report['results'].append(result)
+
+    json.dump(report, open(args.output, 'w'), sort_keys=True, indent=1)
+    print 'Report written to %s' % args.output
+
+
+if __name__ == '__main__':
+    main()
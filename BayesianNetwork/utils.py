@@ -4,21 +4,29 @@ __all__ = ['ExportAsDOT', 'toJSON', 'Summarize']
 Set of utility functions to display or convert Bayesian networks into other formats
 """
 
+def _Open( output ):
+    """
+    File handle to write to from a path or an open file. OUTPUT: the handle and whether it should be closed after writing
+    """
+    if hasattr(output, 'write'): return output, False
+    return open(output, 'w'), True
+
+
+
 def ExportAsDOT( graph, output_path, show_interactions = True, **kwargs ):
     """
-    Export the Bayesian Network to a graphviz *.dot format
+    Export the Bayesian Network to a graphviz *.dot format. The file is written node by node, so memory does not grow 
+    with the size of the network.
     INPUT:  graph - the Bayesian Network that has had its beliefs computed, either through running BeliefPropagation or GetBeliefs
-            output_path - path to the output *.dot file
+            output_path - path to the output *.dot file, or an open file
             show_interactions - whether or not to print interactions or CPTs of each node
             **kwargs - any other arguments for each node. See dot language documentation for more details
     OUTPUT: a *.dot file that can be converted to a visual graph, e.g. dot -Tpdf foo.dot -o foo.pdf. Requires graphviz to be installed
     """
 
-    out = open(output_path,"w")
+    out, close = _Open(output_path)
     out.write('digraph Bayes_Net {\n' )
     
-    node_properties = {}
-    
     header = "<<table border=\"0\" cellborder=\"0\" cellpadding=\"3\" bgcolor=\"white\">"
     VarName = "<tr><td bgcolor=\"black\" align=\"center\" colspan=\"2\"><font color=\"white\">Var Name {VAR}</font></td></tr>"
     Interaction_header = "<tr><td align=\"left\" colspan=\"2\"><font color=\"black\">Interactions</font></td></tr>"
@@ -27,63 +35,65 @@ def ExportAsDOT( graph, output_path, show_interactions = True, **kwargs ):
     Beliefs =  "<tr><td align=\"left\" port=\"r0\"> {LEVEL} &#58; {VALUE}</td></tr>"
     footer = "</table>>"
     
+    ### node instances are written by their index in graph.Nodes
+    index = dict( (Node, i) for i, Node in enumerate(graph.Nodes.values()) )
+    attr = ''.join( ', %s=\"%s\"'%(k, v) for k, v in kwargs.items() )
+    
     for n, Node in graph.Nodes.items():
-        
-        s = VarName.format(VAR=str(n))
-        i  = ''.join([Interaction.format(KEY=k,VALUE=b) for k,b in Node.cpt.iteritems()])
-        b  = ''.join([Beliefs.format(LEVEL=k,VALUE=round(v,4)) for k,v in enumerate(Node.beliefs)])
-        
-        
+        out.write('n%d [label=' % index[Node] + header + VarName.format(VAR=str(n)))
         if show_interactions:
-            node_properties[Node] = {'label':  header + s + Interaction_header + i + Beliefs_header + b + footer}
-        else:
-            node_properties[Node] = {'label':  header + s + Beliefs_header + b + footer}
-        
-        for k,v in kwargs.items():
-            node_properties[Node][k] = '\"' + str(v) + '\"'
-        
-        node_attr = ', '.join([str(key)+'=%s' for key in node_properties[Node]] )
-        attr = node_attr%tuple(node_properties[Node][key] for key in node_properties[Node] )
-        out.write('%s ['%Node+attr+'];\n')
+            out.write(Interaction_header)
+            for k, b in Node.cpt.iteritems():
+                out.write(Interaction.format(KEY=k, VALUE=b))
+        out.write(Beliefs_header)
+        for k, v in enumerate(Node.beliefs):
+            out.write(Beliefs.format(LEVEL=k, VALUE=round(v,4)))
+        out.write(footer + attr + '];\n')
     
     for i,j in graph.edges:
-        out.write('%s -> %s;\n'%(i,j) )
+        out.write('n%d -> n%d;\n'%(index[i], index[j]) )
     
     out.write('}')
-    out.close()
+    if close: out.close()
     return
 
 
 
-def find_index(json_dict, i, inverted_dict):
-    for elem in json_dict:
-        if elem['name'] == inverted_dict[i]: return json_dict.index(elem)
-    return None
-
-
-
-def toJSON(graph,outfile):
+def toJSON(graph, outfile, cpts = 'string'):
     """
-    Output a Bayesian network into a JSON file.
+    Output a Bayesian network into a JSON file. The file is written node by node, so memory does not grow with the size 
+    of the network, and links are written with a precomputed node to index map.
     INPUT:  graph - A Bayesian network with beliefs computed either through BeliefPropagation or GetBeliefs
-            outfile - path to output JSON file
-    OUTPUT: JSON file in the outfile
+            outfile - path to output JSON file, or an open file
+            cpts - how CPTs are written:
+                'string' - dictionary. key=string of the parent levels, value=string of the row
+                'array' - nested lists of shape (parent levels..., levels), with the parent order under 'order'
+                None - not written
+    OUTPUT: JSON file in the outfile. Nodes are in the order of graph.Nodes, links refer to nodes by their position
     """
 
     import json
 
-    inverted_dict = dict( (v,k) for k,v in graph.Nodes.iteritems() )
+    out, close = _Open(outfile)
+    index = dict( (v, i) for i, v in enumerate(graph.Nodes.values()) )
     
-    out_dict = { }
-    out_dict['nodes'] = [ {'name': k} for k,v in graph.Nodes.iteritems()]
-    for dic in out_dict['nodes']:
-        n = dic['name']
-        dic['beliefs'] = dict( (lvl, round(graph.Nodes[n].beliefs[lvl],4) ) for lvl in range(graph.Nodes[n].levels))
-        dic['cpt'] = dict( (str(k), str(graph.Nodes[n].cpt[k]) ) for k in graph.Nodes[n].cpt)
+    out.write('{"nodes": [')
+    for i, (k, node) in enumerate(graph.Nodes.items()):
+        dic = {'name': k}
+        dic['beliefs'] = dict( (lvl, round(b, 4)) for lvl, b in enumerate(node.beliefs) )
+        if cpts == 'string':
+            dic['cpt'] = dict( (str(key), str(row)) for key, row in node.cpt.iteritems() )
+        elif cpts == 'array':
+            dic['cpt'] = [] if node.cpt.table is None else node.cpt.table.tolist()
+            dic['order'] = [str(p) for p in node.order]
+        out.write((', ' if i else '') + json.dumps(dic))
     
-    out_dict['links'] = [ {'source': find_index(out_dict['nodes'],i, inverted_dict), 'target': find_index(out_dict['nodes'], j, inverted_dict )} for i,j in graph.edges ]
+    out.write('], "links": [')
+    for e, (i, j) in enumerate(graph.edges):
+        out.write((', ' if e else '') + '{"source": %d, "target": %d}' % (index[i], index[j]))
+    out.write(']}')
     
-    return json.dump(out_dict,open(outfile,'w') )
+    if close: out.close()
 
 
 
@@ -7,5 +7,5 @@ setup(name='BayesianNetwork',
       description='Construct and calibrate a Bayesian network from survey data using the belief propagation algorithm',
       author='B. Hsu',
       author_email='',
-      packages=['BayesianNetwork']
+      packages=['BayesianNetwork', 'BayesianNetwork.benchmarks']
 )